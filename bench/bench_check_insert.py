@@ -0,0 +1,135 @@
+#!/usr/bin/env python3.11
+"""
+Per-photo p50/p99 latency of duplicate check with insert on sql engine.
+
+    python bench/bench_check_insert.py --rows 10000 --rtt 0.5
+    python bench/bench_check_insert.py --rows 10000 --mysql
+
+Rows: "single" is check_and_insert() of one photo, lookup and insert in
+one transaction; "split" is scan() and insert() in two transactions as
+before; "album" is mysql_check_similarity_many() of 10 photos (one
+scan_many() and one group committed insert_many()), its time is divided
+by photos. By default store is in memory and every transaction sleeps
+--rtt milliseconds for network round trip; --mysql uses MySQLHashStore
+with DBCONFIG of bot.py (table t990000002 is created and filled, drop it
+afterwards).
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "tests"))
+import bot
+from memory_store import MemoryHashStore
+
+CHAT = "-990000002"
+ALBUM = 10
+
+
+class RoundTripStore(MemoryHashStore):
+    """In-memory store, every transaction waits for round trip."""
+    def __init__(self, rtt):
+        super().__init__()
+        self.rtt = rtt
+
+    def scan(self, *args):
+        time.sleep(self.rtt)
+        return super().scan(*args)
+
+    def scan_many(self, *args):
+        time.sleep(self.rtt)
+        return super().scan_many(*args)
+
+    def insert(self, *args):
+        time.sleep(self.rtt)
+        return super().insert(*args)
+
+    def insert_many(self, *args):
+        time.sleep(self.rtt)
+        return super().insert_many(*args)
+
+    def put_file(self, *args):
+        time.sleep(self.rtt)
+        return super().put_file(*args)
+
+    def check_and_insert(self, table, message_id, value, sc, file_unique_id=None):
+        # one transaction like MySQLHashStore
+        time.sleep(self.rtt)
+        res = MemoryHashStore.scan(self, table, value, sc)
+        if not res:
+            MemoryHashStore.insert(self, table, message_id, value, file_unique_id)
+        elif file_unique_id:
+            MemoryHashStore.put_file(self, table, file_unique_id, res[0], value)
+        return res
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return samples[len(samples) // 2], samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=10000, help="hashes already in table")
+    parser.add_argument("--photos", type=int, default=200, help="timed photos per row")
+    parser.add_argument("--rtt", type=float, default=0.5, help="milliseconds per transaction of in-memory store")
+    parser.add_argument("--mysql", action="store_true", help="use mysql instead of in-memory store")
+    args = parser.parse_args()
+
+    bot.SIMILARITY_ENGINE = "sql"
+    if args.mysql:
+        store = bot.MySQLHashStore(bot.MySQLPool(**bot.DBCONFIG))
+    else:
+        store = RoundTripStore(args.rtt / 1000)
+    ib = bot.Imagebot(store, metrics_port=None)
+    table = ib.tg_to_sql_chat_name(CHAT)
+    if args.mysql:
+        store.mysql_pool.execute(f"DROP TABLE IF EXISTS `{table}`", commit=True)
+    store.init_table(table)
+    rnd = random.Random(0)
+    bits = bot.HASH_ALGORITHMS[bot.DEFAULT_HASH_ALGORITHM][2]
+    stored = [rnd.getrandbits(bits) for _ in range(args.rows)]
+    for k in range(0, args.rows, bot.BACKFILL_BATCH):
+        store.insert_many(table, [(m + 1, stored[m]) for m in range(k, min(k + bot.BACKFILL_BATCH, args.rows))])
+
+    message_id = args.rows
+
+    def photo():
+        # a fifth of photos are duplicates of stored ones
+        nonlocal message_id
+        message_id += 1
+        return message_id, rnd.choice(stored) if rnd.random() < 0.2 else rnd.getrandbits(bits), f"f{message_id}"
+
+    def single(i, h, f):
+        store.check_and_insert(table, i, h, bot.SIMILARITY_COEF, f)
+
+    def split(i, h, f):
+        if not store.scan(table, h, bot.SIMILARITY_COEF):
+            store.insert(table, i, h, f)
+
+    print(f"{'path':>7} {'p50 ms':>10} {'p99 ms':>10}")
+    for name, func in (("single", single), ("split", split)):
+        samples = []
+        for _ in range(args.photos):
+            i, h, f = photo()
+            started = time.perf_counter()
+            func(i, h, f)
+            samples.append(time.perf_counter() - started)
+        p50, p99 = percentiles(samples)
+        print(f"{name:>7} {p50 * 1000:>10.3f} {p99 * 1000:>10.3f}")
+    samples = []
+    for _ in range(args.photos // ALBUM):
+        album = [photo() for _ in range(ALBUM)]
+        started = time.perf_counter()
+        ib.mysql_check_similarity_many(CHAT, album)
+        samples.append((time.perf_counter() - started) / ALBUM)
+    p50, p99 = percentiles(samples)
+    print(f"{'album':>7} {p50 * 1000:>10.3f} {p99 * 1000:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3.11
+"""
+Duplicate lookup latency of in-memory HashIndex and NumpyHashIndex
+(when numpy is installed) against full scan with BIT_COUNT per row, the
+way the sql engine does it. Album row is one query_many() of 10 photos.
+
+    python bench/bench_hash_index.py --sizes 10000,100000,1000000
+
+Full scan runs in python by default; --mysql scans a real table through
+MySQLHashStore with DBCONFIG of bot.py instead (table bench_hash_index
+is created and filled, drop it afterwards).
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bot
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def near(value, bits, distance, rnd):
+    for k in rnd.sample(range(bits), distance):
+        value ^= 1 << k
+    return value
+
+
+def timed(func, queries):
+    started = time.perf_counter()
+    for value in queries:
+        func(value)
+    return (time.perf_counter() - started) / len(queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="comma separated numbers of stored hashes")
+    parser.add_argument("--queries", type=int, default=200, help="lookups per engine, half are near-duplicates")
+    parser.add_argument("--distance", type=int, default=bot.SIMILARITY_COEF, help="hamming radius")
+    parser.add_argument("--mysql", action="store_true", help="scan mysql table instead of python list")
+    args = parser.parse_args()
+
+    bits = bot.HASH_ALGORITHMS[bot.DEFAULT_HASH_ALGORITHM][2]
+    rnd = random.Random(0)
+    store = bot.MySQLHashStore(bot.MySQLPool(**bot.DBCONFIG)) if args.mysql else None
+    print(f"{'rows':>9} {'engine':>8} {'build s':>9} {'lookup ms':>10}")
+    for size in map(int, args.sizes.split(",")):
+        hashes = [rnd.getrandbits(bits) for _ in range(size)]
+        queries = [near(rnd.choice(hashes), bits, rnd.randint(0, args.distance), rnd) if k % 2 else rnd.getrandbits(bits)
+                   for k in range(args.queries)]
+
+        started = time.perf_counter()
+        index = bot.HashIndex(bits=bits, max_distance=args.distance)
+        for message_id, value in enumerate(hashes):
+            index.add(message_id, value)
+        build = time.perf_counter() - started
+        lookup = timed(lambda value: index.query(value, args.distance), queries)
+        print(f"{size:>9} {'index':>8} {build:>9.2f} {lookup * 1000:>10.3f}")
+
+        if numpy is not None:
+            started = time.perf_counter()
+            numpy_index = bot.NumpyHashIndex(bits=bits, max_distance=args.distance)
+            for message_id, value in enumerate(hashes):
+                numpy_index.add(message_id, value)
+            build = time.perf_counter() - started
+            lookup = timed(lambda value: numpy_index.query(value, args.distance), queries[:50])
+            print(f"{size:>9} {'numpy':>8} {build:>9.2f} {lookup * 1000:>10.3f}")
+            albums = [queries[k:k + 10] for k in range(0, 50, 10)]
+            lookup = timed(lambda album: numpy_index.query_many(album, args.distance), albums)
+            print(f"{size:>9} {'album':>8} {0:>9.2f} {lookup * 1000:>10.3f}")
+
+        if store is not None:
+            table = "bench_hash_index"
+            store.mysql_pool.execute(f"DROP TABLE IF EXISTS `{table}`", commit=True)
+            started = time.perf_counter()
+            store.init_table(table)
+            for k in range(0, size, bot.BACKFILL_BATCH):
+                store.insert_many(table, [(m, hashes[m]) for m in range(k, min(k + bot.BACKFILL_BATCH, size))])
+            build = time.perf_counter() - started
+            lookup = timed(lambda value: store.scan(table, value, args.distance), queries[:20])
+            print(f"{size:>9} {'mysql':>8} {build:>9.2f} {lookup * 1000:>10.3f}")
+        else:
+            # full scan is slow, fewer queries are enough
+            lookup = timed(lambda value: [m for m, h in enumerate(hashes) if (h ^ value).bit_count() <= args.distance],
+                           queries[:10])
+            print(f"{size:>9} {'scan':>8} {0:>9.2f} {lookup * 1000:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3.11
+"""
+Replay update stream through the whole bot against local fake Bot API
+and report updates per second.
+
+    python bench/bench_replay.py --count 5000 --chats 50
+    python bench/bench_replay.py --updates recorded.jsonl
+
+Stream is JSON lines of updates as getUpdates returns them; without
+--updates a stream of photos (with reposts and near-duplicates) and
+/show_chats commands over --chats chats is generated, --save writes it
+for later replays. Fake Bot API answers getFile with generated images,
+so photos are really downloaded and hashed. Hashes go to in-memory store,
+--mysql uses MySQLHashStore with DBCONFIG of bot.py instead.
+"""
+import argparse
+import asyncio
+import io
+import json
+import logging
+import os
+import random
+import sys
+import time
+from collections import Counter
+from urllib.parse import parse_qs
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "tests"))
+import bot
+from memory_store import MemoryHashStore
+
+
+class FakeBotAPI(object):
+    """
+    Local http server answering Bot API methods used by bot, counts calls.
+    File id up to '-' names generated image, so ids with same prefix are
+    near-duplicates.
+    """
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.message_id = 0
+        self.images = {}
+
+    def image(self, name):
+        data = self.images.get(name)
+        if data is None:
+            from PIL import Image
+
+            rnd = random.Random(name)
+            img = Image.new("L", (64, 64))
+            img.putdata([rnd.randrange(256) for _ in range(64 * 64)])
+            out = io.BytesIO()
+            img.resize((256, 256)).save(out, "JPEG")
+            data = self.images[name] = out.getvalue()
+        return data
+
+    def result(self, method, params):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        if method == "getFile":
+            file_id = params["file_id"]
+            return {"file_id": file_id, "file_unique_id": file_id, "file_path": f"photos/{file_id}.jpg"}
+        if method in ("sendMessage", "editMessageText"):
+            self.message_id += 1
+            return {"message_id": self.message_id, "date": int(time.time()), "text": params.get("text", ""),
+                    "chat": {"id": int(params.get("chat_id", 0)), "type": "supergroup"}}
+        return True
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+                path = head[0].split(" ")[1]
+                headers = {k.strip().lower(): v.strip() for k, _, v in (line.partition(":") for line in head[1:] if line)}
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                await asyncio.sleep(self.latency)
+                if path.startswith("/file/"):
+                    self.calls["download"] += 1
+                    content_type, payload = "image/jpeg", self.image(path.rsplit("/", 1)[1].split("-")[0])
+                else:
+                    method = path.rsplit("/", 1)[1]
+                    self.calls[method] += 1
+                    if headers.get("content-type", "").startswith("application/json"):
+                        params = json.loads(body or b"{}")
+                    else:
+                        params = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+                    content_type = "application/json"
+                    payload = json.dumps({"ok": True, "result": self.result(method, params)}).encode()
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: %s\r\nContent-Length: %d\r\n\r\n%s"
+                             % (content_type.encode(), len(payload), payload))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def __aenter__(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.url = "http://127.0.0.1:%d" % self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *exc):
+        self.server.close()
+
+
+def generate(count, chats, photos, seed=0):
+    """
+    :return: update dicts, photos part of them photos, a quarter of photos are reposts or near-duplicates
+    """
+    rnd = random.Random(seed)
+    chat_ids = [-1001000000000 - k for k in range(chats)]
+    message_ids = Counter()
+    # file ids per chat, duplicates are looked for within chat
+    seen = {chat_id: [] for chat_id in chat_ids}
+    updates = []
+    for update_id in range(1, count + 1):
+        chat_id = rnd.choice(chat_ids)
+        message_ids[chat_id] += 1
+        message = {"message_id": message_ids[chat_id], "date": int(time.time()),
+                   "chat": {"id": chat_id, "type": "supergroup", "title": "bench"},
+                   "from": {"id": 1000 + update_id % 50, "is_bot": False, "first_name": "user"}}
+        if rnd.random() < photos:
+            earlier = seen[chat_id]
+            if earlier and rnd.random() < 0.25:
+                # exact repost keeps file id, near-duplicate is same image as another file
+                file_id = rnd.choice(earlier) if rnd.random() < 0.5 else f"{rnd.choice(earlier).split('-')[0]}-{update_id}"
+            else:
+                file_id = f"img{update_id}-{update_id}"
+                earlier.append(file_id)
+            message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 256, "height": 256}]
+        else:
+            message["text"] = "/show_chats"
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": 11}]
+        updates.append({"update_id": update_id, "message": message})
+    return updates
+
+
+async def replay(updates, store, latency):
+    async with FakeBotAPI(latency) as api:
+        ib = bot.Imagebot(store, bot.HashWorkerPool(), metrics_port=None)
+        application = ib.build_application(api.url)
+        async with application:
+            await ib.post_init(application)
+            # replies shouldn't wait for telegram flood limits here
+            ib.outbound = bot.OutboundQueue(application.bot, chat_rate=1e6, chat_burst=1000,
+                                            global_rate=1e6, global_burst=1000)
+            await application.start()
+            started = time.perf_counter()
+            for data in updates:
+                application.update_queue.put_nowait(bot.Update.de_json(data, application.bot))
+            await application.update_queue.join()
+            handled = time.perf_counter() - started
+            while ib.outbound.senders or ib.albums:
+                await asyncio.sleep(0.01)
+            replied = time.perf_counter() - started
+            await application.stop()
+            await ib.post_shutdown(application)
+    return handled, replied, api.calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--updates", help="JSON lines file of recorded updates")
+    parser.add_argument("--count", type=int, default=2000, help="updates to generate")
+    parser.add_argument("--chats", type=int, default=20, help="chats of generated updates")
+    parser.add_argument("--photos", type=float, default=0.8, help="part of generated updates with photo")
+    parser.add_argument("--save", help="write generated updates to this file")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds fake Bot API waits before answering")
+    parser.add_argument("--concurrent-updates", type=int, default=bot.CONCURRENT_UPDATES, help="updates processed at once")
+    parser.add_argument("--mysql", action="store_true", help="store hashes in mysql instead of memory")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.updates:
+        with open(args.updates, encoding="utf-8") as f:
+            updates = [json.loads(line) for line in f if line.strip()]
+    else:
+        updates = generate(args.count, args.chats, args.photos)
+        if args.save:
+            with open(args.save, "w", encoding="utf-8") as f:
+                f.writelines(json.dumps(u) + "\n" for u in updates)
+    bot.TOKEN = "123456:bench"
+    bot.CONCURRENT_UPDATES = args.concurrent_updates
+    bot.COMPACTION_INTERVAL = 0
+    store = bot.MySQLHashStore(bot.MySQLPool(**bot.DBCONFIG)) if args.mysql else MemoryHashStore()
+
+    handled, replied, calls = asyncio.run(replay(updates, store, args.latency))
+    print(f"{len(updates)} updates in {handled:.2f}s, {len(updates) / handled:.0f} updates/s, "
+          f"replies sent after {replied:.2f}s")
+    print("bot api calls:", ", ".join(f"{k}={v}" for k, v in sorted(calls.items())))
+    print(bot.metrics.summary())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3.11
+"""
+Bytes per row and lookup cost of H0/H1 schema against legacy A0..A3
+columns compared by hamming_32() with query hash sliced by CONV(SUBSTRING()).
+
+    python bench/bench_schema.py --rows 100000
+    python bench/bench_schema.py --rows 100000 --mysql
+
+Without --mysql bytes per row are InnoDB COMPACT sizes of the columns
+(fixed header, transaction id and roll pointer included) and lookup
+runs both predicates row by row in python, including the per-row hex
+slicing of legacy query. --mysql fills tables t990000003 (H0/H1) and
+t990000004 (A0..A3) with DBCONFIG of bot.py, creates hamming_32 and
+reports AVG_ROW_LENGTH of information_schema and real SELECT times;
+drop the tables afterwards.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bot
+
+LEGACY_STRUCTURE = ''' (
+  `message_id` int(11) NOT NULL,
+  `A0` bigint(20) DEFAULT NULL,
+  `A1` bigint(20) DEFAULT NULL,
+  `A2` bigint(20) DEFAULT NULL,
+  `A3` bigint(20) DEFAULT NULL,
+  PRIMARY KEY (`message_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci'''
+
+HAMMING_32 = '''CREATE FUNCTION hamming_32(A0 BIGINT, A1 BIGINT, A2 BIGINT, A3 BIGINT, B0 BIGINT, B1 BIGINT, B2 BIGINT, B3 BIGINT)
+RETURNS BIGINT DETERMINISTIC
+RETURN BIT_COUNT(A0 ^ B0) + BIT_COUNT(A1 ^ B1) + BIT_COUNT(A2 ^ B2) + BIT_COUNT(A3 ^ B3)'''
+
+# record header, transaction id and roll pointer of InnoDB COMPACT row
+ROW_OVERHEAD = 5 + 6 + 7
+# message_id int, nullable bigints A0..A3 with null bitmap byte
+LEGACY_ROW = 4 + 4 * 8 + 1
+# message_id int, H0 and H1 bigint, created_at timestamp, NULL alias_ids with null bitmap byte
+ROW = 4 + 2 * 8 + 4 + 1
+
+
+def legacy_columns(value):
+    h = f"{value:0{bot.legacy_hex_len}x}"
+    return [int(h[8 * k:8 * k + 8], 16) for k in range(4)]
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return samples[len(samples) // 2], samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+
+
+def timed(func, queries):
+    samples = []
+    for value in queries:
+        started = time.perf_counter()
+        func(value)
+        samples.append(time.perf_counter() - started)
+    return percentiles(samples)
+
+
+def python_lookups(hashes, queries, distance):
+    legacy = [(m, *legacy_columns(value)) for m, value in enumerate(hashes)]
+    rows = [(m, *bot.split_hash(value)) for m, value in enumerate(hashes)]
+
+    def legacy_scan(value):
+        h = f"{value:0{bot.legacy_hex_len}x}"
+        # CONV(SUBSTRING(h, ...), 16, 10) is part of the row predicate
+        return [m for m, a0, a1, a2, a3 in legacy
+                if (a0 ^ int(h[0:8], 16)).bit_count() + (a1 ^ int(h[8:16], 16)).bit_count()
+                + (a2 ^ int(h[16:24], 16)).bit_count() + (a3 ^ int(h[24:], 16)).bit_count() <= distance]
+
+    def scan(value):
+        h0, h1 = bot.split_hash(value)
+        return [m for m, r0, r1 in rows if (r0 ^ h0).bit_count() + (r1 ^ h1).bit_count() <= distance]
+
+    assert legacy_scan(queries[0]) == scan(queries[0])
+    return timed(legacy_scan, queries), timed(scan, queries)
+
+
+def mysql_lookups(hashes, queries, distance):
+    pool = bot.MySQLPool(**bot.DBCONFIG)
+    table, legacy = "t990000003", "t990000004"
+    for name, structure in ((table, bot.table_structure), (legacy, LEGACY_STRUCTURE)):
+        pool.execute(f"DROP TABLE IF EXISTS `{name}`", commit=True)
+        pool.execute(f"CREATE TABLE `{name}` {structure}", commit=True)
+    pool.execute("DROP FUNCTION IF EXISTS hamming_32", commit=True)
+    pool.execute(HAMMING_32, commit=True)
+    rows = list(enumerate(hashes))
+    for k in range(0, len(rows), bot.BACKFILL_BATCH):
+        chunk = rows[k:k + bot.BACKFILL_BATCH]
+        pool.executemany(f"INSERT INTO `{table}` (message_id, H0, H1) VALUES (%s, %s, %s)",
+                         [(m, *bot.split_hash(value)) for m, value in chunk], commit=True)
+        pool.executemany(f"INSERT INTO `{legacy}` (message_id, A0, A1, A2, A3) VALUES (%s, %s, %s, %s, %s)",
+                         [(m, *legacy_columns(value)) for m, value in chunk], commit=True)
+    sizes = {}
+    for name in (table, legacy):
+        pool.execute(f"ANALYZE TABLE `{name}`")
+        rows = pool.execute("SELECT AVG_ROW_LENGTH FROM information_schema.TABLES "
+                            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s", (name,))
+        sizes[name] = rows[0][0]
+
+    def legacy_scan(value):
+        h = f"{value:0{bot.legacy_hex_len}x}"
+        return pool.execute(
+            f"SELECT `message_id` FROM `{legacy}` WHERE hamming_32(A0, A1, A2, A3, "
+            f"CONV(SUBSTRING('{h}', 1, 8), 16, 10), CONV(SUBSTRING('{h}', 9, 8), 16, 10), "
+            f"CONV(SUBSTRING('{h}', 17, 8), 16, 10), CONV(SUBSTRING('{h}', 25, 8), 16, 10)) <= {distance};")
+
+    def scan(value):
+        return pool.execute(f"SELECT `message_id` FROM `{table}` WHERE BIT_COUNT(H0 ^ %s) + BIT_COUNT(H1 ^ %s) <= %s",
+                            (*bot.split_hash(value), distance))
+
+    return (sizes[legacy], sizes[table]), timed(legacy_scan, queries), timed(scan, queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=100000, help="hashes per table")
+    parser.add_argument("--queries", type=int, default=20, help="timed lookups")
+    parser.add_argument("--distance", type=int, default=bot.SIMILARITY_COEF, help="hamming radius")
+    parser.add_argument("--mysql", action="store_true", help="measure in mysql instead of python")
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    bits = bot.HASH_ALGORITHMS[bot.DEFAULT_HASH_ALGORITHM][2]
+    hashes = [rnd.getrandbits(bits) for _ in range(args.rows)]
+    queries = [rnd.choice(hashes) ^ (1 << rnd.randrange(bits)) if k % 2 else rnd.getrandbits(bits) for k in range(args.queries)]
+    if args.mysql:
+        (legacy_size, size), legacy, new = mysql_lookups(hashes, queries, args.distance)
+    else:
+        legacy_size, size = LEGACY_ROW + ROW_OVERHEAD, ROW + ROW_OVERHEAD
+        legacy, new = python_lookups(hashes, queries, args.distance)
+    print(f"{'schema':>7} {'bytes/row':>10} {'p50 ms':>10} {'p99 ms':>10}")
+    print(f"{'A0..A3':>7} {legacy_size:>10} {legacy[0] * 1000:>10.2f} {legacy[1] * 1000:>10.2f}")
+    print(f"{'H0/H1':>7} {size:>10} {new[0] * 1000:>10.2f} {new[1] * 1000:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3.11
+"""
+Insert and lookup latency of hash store backends.
+
+    python bench/bench_stores.py --rows 100000
+    python bench/bench_stores.py --rows 100000 --mysql
+
+Table is filled with --rows hashes by insert_many(), then single
+insert() with telegram file, get_file() and scan() are timed one by
+one. RocksHashStore runs in a temporary directory; --mysql adds
+MySQLHashStore with DBCONFIG of bot.py (table bench_stores is created
+and filled, drop it afterwards).
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bot
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return samples[len(samples) // 2], samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+
+
+def timed(func, args):
+    samples = []
+    for a in args:
+        started = time.perf_counter()
+        func(*a)
+        samples.append(time.perf_counter() - started)
+    return percentiles(samples)
+
+
+def run(name, store, table, rows, queries, distance):
+    started = time.perf_counter()
+    store.init_table(table)
+    for k in range(0, len(rows), bot.BACKFILL_BATCH):
+        store.insert_many(table, rows[k:k + bot.BACKFILL_BATCH])
+    fill = time.perf_counter() - started
+    print(f"{name:>6} {'fill':>10} {len(rows) / fill:>10.0f} rows/s")
+
+    rnd = random.Random(1)
+    first = len(rows) + 1
+    inserts = [(table, first + k, rnd.getrandbits(121), f"f{first + k}") for k in range(queries)]
+    results = [("insert", timed(store.insert, inserts)),
+               ("get_file", timed(store.get_file, [(table, f) for *_, f in inserts])),
+               ("load", timed(lambda t: list(store.load(t, after=first)), [(table,)] * 10)),
+               ("scan", timed(store.scan, [(table, value, distance) for _, _, value, _ in inserts[:20]]))]
+    for operation, (p50, p99) in results:
+        print(f"{name:>6} {operation:>10} {p50 * 1000:>10.3f} {p99 * 1000:>10.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=100000, help="hashes in table")
+    parser.add_argument("--queries", type=int, default=500, help="timed inserts and file lookups")
+    parser.add_argument("--distance", type=int, default=bot.SIMILARITY_COEF, help="hamming radius of scan")
+    parser.add_argument("--mysql", action="store_true", help="also run MySQLHashStore")
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    rows = [(message_id, rnd.getrandbits(121)) for message_id in range(1, args.rows + 1)]
+    print(f"{'store':>6} {'operation':>10} {'p50 ms':>10} {'p99 ms':>10}")
+    with tempfile.TemporaryDirectory() as path:
+        store = bot.RocksHashStore(os.path.join(path, "db"))
+        run("rocks", store, "bench_stores", rows, args.queries, args.distance)
+        store.close()
+    if args.mysql:
+        store = bot.MySQLHashStore(bot.MySQLPool(**bot.DBCONFIG))
+        store.mysql_pool.execute("DROP TABLE IF EXISTS `bench_stores`", commit=True)
+        run("mysql", store, "bench_stores", rows, args.queries, args.distance)
+
+
+if __name__ == "__main__":
+    main()
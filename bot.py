@@ -1,22 +1,33 @@
 #!/usr/bin/env python3.11
 
+import argparse
 import html
+import io
 import json
-import urllib 
 import logging
 import traceback
 import os
+import asyncio
+import bisect
+import contextlib
+import functools
+import hashlib
+import multiprocessing
+import tempfile
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from urllib.parse import urlsplit
 from typing import Optional, Tuple, Literal, TypeAlias
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import datetime, timedelta
 from enum import IntEnum
-from PIL import Image
-import imagehash
-import mysql.connector.pooling
+import httpx
 
-import openai
-from IPython.display import display, Markdown
-import yfinance as yf
+# heavy feature modules (PIL, imagehash, openai, mysql.connector, rocksdict) are imported
+# where they are first needed, so startup doesn't pay for scipy, pandas etc.
 
 from telegram import __version__ as TG_VER
 try:
@@ -30,20 +41,82 @@ if __version_info__ < (20, 0, 0, "alpha", 1):
         f"{TG_VER} version of this example, "
         f"visit https://docs.python-telegram-bot.org/en/v{TG_VER}/examples.html"
     )
-from telegram import Update, ChatMemberUpdated, ChatMember, Chat
-from telegram.constants import ParseMode
+from telegram import Update, ChatMemberUpdated, ChatMember, Chat, ReplyParameters
+from telegram.constants import ParseMode, MessageLimit
+from telegram.error import RetryAfter, TelegramError
 from telegram.ext import Application, CommandHandler, ContextTypes, ChatMemberHandler, CallbackContext
-from telegram.ext import MessageHandler
+from telegram.ext import MessageHandler, TypeHandler
+from telegram.ext import BaseUpdateProcessor
 from telegram.ext import filters
 
 
 # globals
-openai.api_key = ""
+OPENAI_API_KEY = ""
+# any OpenAI-compatible server, None for api.openai.com
+OPENAI_BASE_URL = None
+GPT_MODEL = "gpt-3.5-turbo"
+# completions in flight for whole bot and for one chat
+GPT_MAX_CONCURRENCY = 8
+GPT_CHAT_CONCURRENCY = 1
+# answers of repeated identical prompts, 0 disables cache
+GPT_CACHE_SIZE = 256
+# seconds between edits of streamed reply
+GPT_EDIT_INTERVAL = 1.0
 TOKEN = ""
+# updates processed at once, updates of one chat are still handled in order
+CONCURRENT_UPDATES = 64
+# updates taken from queue at once, running or waiting for earlier update of their chat
+PENDING_UPDATES = 4096
+# sharding: virtual nodes per worker on hash ring, directory for local worker sockets
+SHARD_VNODES = 64
+SHARD_SOCKET_DIR = tempfile.gettempdir()
+# outbound messages per second and burst for one chat and for whole bot, telegram floods
+# at about 1/s per chat and 30/s total; messages waiting for a chat are merged where possible
+SEND_CHAT_RATE = 1.0
+SEND_CHAT_BURST = 3
+SEND_GLOBAL_RATE = 25.0
+SEND_GLOBAL_BURST = 30
 OPENWEATHER_APP_ID = ''
+OPENWEATHER_URL = "https://api.openweathermap.org/data/2.5/weather"
+# seconds to wait for openweather and to keep answers for the same city
+WEATHER_TIMEOUT = 10
+WEATHER_CACHE_TTL = 600
 DEVELOPER_CHAT_ID = "-1001789876771"
+# user ids allowed to run admin commands like /stats, besides developer chat
+ADMIN_USER_IDS = set()
+# prometheus text endpoint, None disables it
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9100
 TEMP_DIR = 'tmpdir/'
+# download photos into memory instead of TEMP_DIR
+IMAGE_IN_MEMORY = True
+# image hashing workers: "process" or "thread" pool, queue_size bounds images waiting for a worker
+HASH_WORKER_KIND = "process"
+HASH_WORKERS = os.cpu_count() or 1
+HASH_QUEUE_SIZE = 64
 SIMILARITY_COEF = 4
+# perceptual hash per chat id, name from HASH_ALGORITHMS, chats not listed use default
+DEFAULT_HASH_ALGORITHM = "ahash"
+CHAT_HASH_ALGORITHMS = {}
+# exact reposts are found by telegram file_unique_id before download, cache keeps hot ones in memory
+FILE_ID_CACHE_SIZE = 100000
+# photos of one album (media group) arriving within this many seconds are checked together
+ALBUM_WINDOW = 1.0
+# "index" answers lookups from in-memory per-chat index, "sql" scans table with BIT_COUNT,
+# "numpy" compares with all hashes of chat at once, snapshots are memory-mapped from NUMPY_DIR
+SIMILARITY_ENGINE = "index"
+NUMPY_DIR = 'hashes.numpy'
+# per chat id {"max_age_days": ..., "max_rows": ...}, chats not listed use default, None keeps everything
+DEFAULT_RETENTION = {"max_age_days": None, "max_rows": None}
+CHAT_RETENTION = {}
+# background compaction every this many seconds (0 disables), drops rows out of retention
+# and merges hashes this close (None disables merging) into the oldest row which keeps ids of merged ones
+COMPACTION_INTERVAL = 3600
+COMPACTION_DISTANCE = 1
+
+# where hashes are kept: "mysql" or "rocksdb" (embedded, single node)
+STORAGE_BACKEND = "mysql"
+ROCKSDB_PATH = 'hashes.rocksdb'
 
 DBCONFIG = {
     "host":"127.0.0.1",
@@ -53,35 +126,514 @@ DBCONFIG = {
     "database":"test",
     "pool_name":"bot_pool"
 }
+# connections kept open, opened under load, seconds to wait for one,
+# seconds idle before closing extra one, seconds idle before ping on checkout
+MYSQL_POOL_MIN_SIZE = 1
+MYSQL_POOL_MAX_SIZE = 10
+MYSQL_POOL_TIMEOUT = 10
+MYSQL_POOL_IDLE_TIMEOUT = 300
+MYSQL_POOL_HEALTH_CHECK = 30
+# prepared statements kept per connection, mysql limits them server-wide by max_prepared_stmt_count
+MYSQL_PREPARED_CACHE_SIZE = 64
 # end globals
 
 current_dir = os.getcwd()
 TEMP_DIR_FULL_PATH = f"{current_dir}/{TEMP_DIR}"
-if not os.path.exists(TEMP_DIR_FULL_PATH):
+if not IMAGE_IN_MEMORY and not os.path.exists(TEMP_DIR_FULL_PATH):
     os.mkdir(TEMP_DIR_FULL_PATH)
 
 # mysql db settings
+# hash up to 128 bits is stored as two unsigned halves, H0 high and H1 low 64 bits
 table_structure = ''' (
   `message_id` int(11) NOT NULL,
-  `A0` bigint(20) DEFAULT NULL,
-  `A1` bigint(20) DEFAULT NULL,
-  `A2` bigint(20) DEFAULT NULL,
-  `A3` bigint(20) DEFAULT NULL,
+  `H0` bigint(20) unsigned NOT NULL,
+  `H1` bigint(20) unsigned NOT NULL,
+  `created_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `alias_ids` text DEFAULT NULL,
   PRIMARY KEY (`message_id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci'''
 
-# not fastest but will do
-hamming_func = '''DELIMITER $$
-create function hamming_32(A0 BIGINT, A1 BIGINT, A2 BIGINT, A3 BIGINT, B0 BIGINT, B1 BIGINT, B2 BIGINT, B3 BIGINT) RETURNS BIGINT 
-BEGIN 
-  DECLARE RET BIGINT; 
-  SET ret = BIT_COUNT(A0 ^ B0) + BIT_COUNT(A1 ^ B1) + BIT_COUNT(A2 ^ B2) + BIT_COUNT(A3 ^ B3); 
-  return ret;
-END;
-$$'''
+# file_unique_id -> first message with this file, per chat table
+file_ids_table = 'file_ids'
+file_ids_structure = ''' (
+  `chat_table` varchar(64) NOT NULL,
+  `file_unique_id` varchar(64) NOT NULL,
+  `message_id` int(11) NOT NULL,
+  `H0` bigint(20) unsigned NOT NULL,
+  `H1` bigint(20) unsigned NOT NULL,
+  PRIMARY KEY (`chat_table`, `file_unique_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci'''
+
+# bumped on changes which aren't appends of newer messages, snapshots of older generation are stale
+generations_table = 'generations'
+generations_structure = ''' (
+  `chat_table` varchar(64) NOT NULL,
+  `generation` bigint(20) unsigned NOT NULL,
+  PRIMARY KEY (`chat_table`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci'''
+bump_generation = f"INSERT INTO `{generations_table}` (chat_table, generation) VALUES (%s, 1) ON DUPLICATE KEY UPDATE generation = generation + 1"
+
+ins_file = f"INSERT IGNORE INTO `{file_ids_table}` (chat_table, file_unique_id, message_id, H0, H1) VALUES (%s, %s, %s, %s, %s)"
+
+# rows per bulk insert of --backfill
+BACKFILL_BATCH = 1000
+# ids per DELETE ... IN (...) of compaction
+COMPACTION_BATCH = 1000
+
+# old tables kept average_hash(hash_size=11) hex as A0..A3 (8 hex chars each, A3 the rest),
+# converted to H0/H1 with --migrate
+legacy_hex_len = 31
 table_prefix= 't'
 # end mysql db settings
 
+### start hash index
+HASH_ALGORITHMS = {
+    # name: (imagehash function, kwargs, hash bits)
+    "ahash": ("average_hash", {"hash_size": 11}, 121),
+    "phash": ("phash", {"hash_size": 11}, 121),
+    "dhash": ("dhash", {"hash_size": 11}, 121),
+    "whash": ("whash", {"hash_size": 8}, 64),
+    "colorhash": ("colorhash", {"binbits": 3}, 42),
+}
+HASH_MASK = (1 << 64) - 1
+
+def split_hash(value: int) -> Tuple[int, int]:
+    """Split hash int to H0, H1 columns."""
+    return value >> 64, value & HASH_MASK
+
+def join_hash(h0: int, h1: int) -> int:
+    """Join H0, H1 columns back to hash int."""
+    return (h0 << 64) | h1
+
+def legacy_hash_sql() -> Tuple[str, str]:
+    """Return mysql expressions of H0 and H1 over legacy A0..A3 columns.
+
+    Returns:
+        tuple: H0 and H1 expressions
+    """
+    # Ak holds hex chars 8k..8k+7, mysql returns 0 for shifts >= 64 which drops bits outside of the half
+    shifts = [4 * (legacy_hex_len - 8 * (k + 1)) for k in range(3)] + [0]
+    high = " | ".join(f"(A{k} << {s - 64})" if s >= 64 else f"(A{k} >> {64 - s})" for k, s in enumerate(shifts))
+    low = " | ".join(f"(A{k} << {s})" for k, s in enumerate(shifts))
+    return high, low
+
+def table_algorithm(table: str) -> Optional[str]:
+    """Return hash algorithm of chat table or None if table isn't chat table.
+
+    Args:
+        table (str): table name
+
+    Returns:
+        str: hash algorithm
+    """
+    name, _, algorithm = table.partition('_')
+    algorithm = algorithm or "ahash"
+    if name.startswith(table_prefix) and name[len(table_prefix):].isdigit() and algorithm in HASH_ALGORITHMS:
+        return algorithm
+    return None
+
+class HashIndex(object):
+    """
+    Pigeonhole multi-index for near-neighbour lookup of image hashes.
+    Hash is split into max_distance + 1 bands, any hash within max_distance
+    of the query shares at least one band with it exactly, so only hashes
+    found in band tables are compared instead of the whole chat.
+    """
+    def __init__(self, bits: int = 128, max_distance: int = SIMILARITY_COEF):
+        self.bits = bits
+        self.max_distance = max_distance
+        n = max_distance + 1
+        bounds = [bits * k // n for k in range(n + 1)]
+        self._bands = [(lo, (1 << (hi - lo)) - 1) for lo, hi in zip(bounds, bounds[1:])]
+        self._tables = [{} for _ in self._bands]
+        self._hashes = {}
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def add(self, message_id: int, value: int) -> None:
+        """Add hash of message to index.
+
+        Args:
+            message_id (int): message id
+            value (int): image hash
+        """
+        self._hashes[message_id] = value
+        for table, (shift, mask) in zip(self._tables, self._bands):
+            table.setdefault((value >> shift) & mask, set()).add(message_id)
+
+    def query(self, value: int, max_distance: Optional[int] = None) -> list:
+        """Find messages with hash not further than max_distance.
+
+        Args:
+            value (int): image hash
+            max_distance (int, optional): hamming radius. Defaults to index radius.
+
+        Returns:
+            list: sorted message ids
+        """
+        if max_distance is None:
+            max_distance = self.max_distance
+        if max_distance > self.max_distance:
+            # pigeonhole guarantee holds only up to index radius
+            candidates = self._hashes.keys()
+        else:
+            candidates = set()
+            for table, (shift, mask) in zip(self._tables, self._bands):
+                candidates.update(table.get((value >> shift) & mask, ()))
+        return sorted(m for m in candidates if (self._hashes[m] ^ value).bit_count() <= max_distance)
+
+    def remove(self, message_id: int) -> None:
+        """Remove hash of message from index, unknown ids are ignored.
+
+        Args:
+            message_id (int): message id
+        """
+        value = self._hashes.pop(message_id, None)
+        if value is None:
+            return
+        for table, (shift, mask) in zip(self._tables, self._bands):
+            key = (value >> shift) & mask
+            ids = table.get(key)
+            if ids is not None:
+                ids.discard(message_id)
+                if not ids:
+                    del table[key]
+
+    def query_many(self, values: list, max_distance: Optional[int] = None) -> list:
+        """Batch query(), e.g. for album.
+
+        Args:
+            values (list): image hashes
+            max_distance (int, optional): hamming radius. Defaults to index radius.
+
+        Returns:
+            list: sorted message ids for every hash
+        """
+        return [self.query(value, max_distance) for value in values]
+
+
+# rows compared at once by NumpyHashIndex, bounds temporary arrays of album queries
+NUMPY_CHUNK = 1 << 16
+
+class NumpyHashIndex(object):
+    """
+    Brute force near-neighbour lookup over packed hash matrix, same
+    interface as HashIndex. Rows are (message_id, H0, H1) uint64, distance
+    to every row is XOR and popcount of both words, vectorized by numpy.
+    Saved snapshot is memory-mapped on open, rows added later are kept in
+    growing in-memory tail until next save(). Snapshot is used only if it
+    was saved at the same store generation, see HashStore.generation().
+    """
+    def __init__(self, bits: int = 128, max_distance: int = SIMILARITY_COEF, path: Optional[str] = None,
+                 generation: int = 0):
+        import numpy as np
+
+        self.np = np
+        self.bits = bits
+        self.max_distance = max_distance
+        self.path = path
+        # store generation rows of index correspond to
+        self.generation = generation
+        self._saved_generation = None
+        self._base = np.empty((0, 3), dtype=np.uint64)
+        if path and os.path.exists(path) and self._read_generation() == generation:
+            self._base = np.load(path, mmap_mode="r")
+            self._saved_generation = generation
+        self._tail = np.empty((1024, 3), dtype=np.uint64)
+        self._tail_len = 0
+        # removed rows are skipped by queries and dropped on save()
+        self._removed = set()
+
+    def __len__(self) -> int:
+        return len(self._base) + self._tail_len - len(self._removed)
+
+    def last_id(self) -> Optional[int]:
+        """
+        Returns:
+            int: newest message id of snapshot, rows after it are to be added from store
+        """
+        return int(self._base[:, 0].max()) if len(self._base) else None
+
+    def add(self, message_id: int, value: int) -> None:
+        """Add hash of message to index.
+
+        Args:
+            message_id (int): message id
+            value (int): image hash
+        """
+        if self._tail_len == len(self._tail):
+            self._tail = self.np.concatenate((self._tail, self.np.empty_like(self._tail)))
+        self._tail[self._tail_len] = (message_id, *split_hash(value))
+        self._tail_len += 1
+        self._removed.discard(message_id)
+
+    def remove(self, message_id: int) -> None:
+        """Remove hash of message from index, message must be in index.
+
+        Args:
+            message_id (int): message id
+        """
+        self._removed.add(message_id)
+
+    def query(self, value: int, max_distance: Optional[int] = None) -> list:
+        """Find messages with hash not further than max_distance.
+
+        Args:
+            value (int): image hash
+            max_distance (int, optional): hamming radius. Defaults to index radius.
+
+        Returns:
+            list: sorted message ids
+        """
+        return self.query_many([value], max_distance)[0]
+
+    def query_many(self, values: list, max_distance: Optional[int] = None) -> list:
+        """Batch query(), all hashes are compared in one pass over rows.
+
+        Args:
+            values (list): image hashes
+            max_distance (int, optional): hamming radius. Defaults to index radius.
+
+        Returns:
+            list: sorted message ids for every hash
+        """
+        np = self.np
+        if max_distance is None:
+            max_distance = self.max_distance
+        queries = np.array([split_hash(value) for value in values], dtype=np.uint64).reshape(-1, 2)
+        results = [[] for _ in values]
+        for rows in (self._base, self._tail[:self._tail_len]):
+            for start in range(0, len(rows), NUMPY_CHUNK):
+                chunk = rows[start:start + NUMPY_CHUNK]
+                # (queries, rows) distances, popcount of a word fits uint8 and so does the sum
+                distances = (np.bitwise_count(chunk[:, 1] ^ queries[:, 0:1])
+                             + np.bitwise_count(chunk[:, 2] ^ queries[:, 1:2]))
+                for k, j in zip(*np.nonzero(distances <= max_distance)):
+                    results[k].append(int(chunk[j, 0]))
+        return [sorted(m for m in res if m not in self._removed) for res in results]
+
+    def _read_generation(self) -> Optional[int]:
+        try:
+            with open(f"{self.path}.generation") as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def save(self) -> None:
+        """Write snapshot with all rows and map it instead of in-memory ones."""
+        np = self.np
+        if not self._tail_len and not self._removed and self._saved_generation == self.generation:
+            return
+        rows = np.concatenate((self._base, self._tail[:self._tail_len]))
+        if self._removed:
+            rows = rows[~np.isin(rows[:, 0], np.array(list(self._removed), dtype=np.uint64))]
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        # replaced at once, crash while writing keeps previous snapshot
+        tmp = f"{self.path}.tmp.npy"
+        np.save(tmp, rows)
+        os.replace(tmp, self.path)
+        # written after rows, crash in between leaves generation of previous snapshot
+        # which at worst makes next start rebuild from store
+        with open(f"{self.path}.generation.tmp", "w") as f:
+            f.write(str(self.generation))
+        os.replace(f"{self.path}.generation.tmp", f"{self.path}.generation")
+        self._saved_generation = self.generation
+        self._base = np.load(self.path, mmap_mode="r")
+        self._tail_len = 0
+        self._removed = set()
+### end hash index
+
+### start image hashing
+IMAGE_DRAFT_SIZE = (128, 128)
+
+def hash_image(fp, algorithm: str = DEFAULT_HASH_ALGORITHM) -> int:
+    """Decode image once at reduced scale and return its perceptual hash.
+
+    Args:
+        fp: file path or file object (BytesIO for in-memory downloads)
+        algorithm (str, optional): name from HASH_ALGORITHMS. Defaults to DEFAULT_HASH_ALGORITHM.
+
+    Returns:
+        int: hash bits
+    """
+    from PIL import Image
+    import imagehash
+
+    func, kwargs, _ = HASH_ALGORITHMS[algorithm]
+    with Image.open(fp) as img:
+        # hashes need only a tiny image, let jpeg decoder downscale by 1/2..1/8 while decoding,
+        # grayscale is enough for everything except colorhash
+        img.draft("RGB" if algorithm == "colorhash" else "L", IMAGE_DRAFT_SIZE)
+        return int(str(getattr(imagehash, func)(img, **kwargs)), 16)
+
+def hash_image_data(data: bytes, algorithm: str = DEFAULT_HASH_ALGORITHM) -> int:
+    """Hash image from bytes, picklable entry point for process pool."""
+    return hash_image(io.BytesIO(data), algorithm)
+
+def hash_image_file(path: str, algorithm: str = DEFAULT_HASH_ALGORITHM) -> Optional[int]:
+    """Hash image file for backfill, broken or missing file gives None instead of stopping the batch."""
+    try:
+        return hash_image(path, algorithm)
+    except Exception:
+        return None
+
+class HashWorkerPool(object):
+    """
+    Hash images in a process or thread pool outside of event loop thread.
+    Jobs go through a bounded queue, so when workers are behind, handlers
+    wait for a free slot instead of piling images up in memory.
+    """
+    def __init__(self, kind=HASH_WORKER_KIND, workers=HASH_WORKERS, queue_size=HASH_QUEUE_SIZE):
+        self.kind = kind
+        self.workers = workers
+        self.queue_size = queue_size
+        self.executor = None
+        self.queue = None
+        self.processed = 0
+        self.max_depth = 0
+        self._tasks = []
+        self.logger = logging.getLogger(__name__)
+
+    async def start(self):
+        """
+        Create executor and queue consumers, must be called inside running loop.
+        """
+        if self.kind == "process":
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="hash")
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        metrics.gauge("hash_queue_depth", self.queue.qsize)
+        metrics.gauge("hash_queue_max_depth", lambda: self.max_depth)
+        metrics.gauge("hash_processed", lambda: self.processed)
+        self._tasks = [asyncio.create_task(self._consume()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """
+        Cancel consumers and shut executor down.
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _consume(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            func, args, future = await self.queue.get()
+            try:
+                if not future.done():
+                    result = await loop.run_in_executor(self.executor, func, *args)
+                    if not future.done():
+                        future.set_result(result)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self.processed += 1
+                self.queue.task_done()
+
+    async def submit(self, func, *args):
+        """
+        Queue func(*args) for a worker, waits while queue is full.
+        :param func: picklable module level function
+        :param args: picklable args
+        :return: result of func
+        """
+        future = asyncio.get_running_loop().create_future()
+        if self.queue.full():
+            self.logger.warning("hash queue is full ({}), waiting for workers".format(self.queue_size))
+        await self.queue.put((func, args, future))
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return await future
+
+    async def hash(self, data, algorithm=DEFAULT_HASH_ALGORITHM) -> int:
+        """
+        Hash downloaded image.
+        :param data: image bytes
+        :param algorithm: name from HASH_ALGORITHMS
+        :return: hash int
+        """
+        return await self.submit(hash_image_data, bytes(data), algorithm)
+### end image hashing
+
+### start caches
+class LRUCache(object):
+    """
+    Thread-safe least recently used cache of limited size.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+class TTLCache(object):
+    """
+    Cache of coroutine results which expire after ttl seconds, for use
+    from event loop only. Concurrent requests of the same missing key
+    share one call instead of making their own.
+    """
+    def __init__(self, ttl=600, maxsize=1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._pending = {}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    async def get(self, key, fetch):
+        """
+        Return cached value of key or await fetch() to get it.
+        :param key: cache key
+        :param fetch: coroutine function without args
+        :return: value
+        """
+        item = self._data.get(key)
+        if item is not None and item[0] > time.monotonic():
+            return item[1]
+        future = self._pending.get(key)
+        if future is None:
+            future = self._pending[key] = asyncio.ensure_future(fetch())
+            future.add_done_callback(functools.partial(self._done, key))
+        # one waiter being cancelled must not cancel the call for the others
+        return await asyncio.shield(future)
+
+    def _done(self, key, future) -> None:
+        self._pending.pop(key, None)
+        if future.cancelled() or future.exception() is not None:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, future.result())
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+### end caches
+
 # weather setup
 @dataclass(slots=True, frozen=True)
 class Coordinates:
@@ -112,11 +664,301 @@ class Weather:
     sunset: datetime
 # end weather setup
 
+### start metrics
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Histogram(object):
+    """
+    Latency histogram with fixed buckets (seconds), same as prometheus one.
+    """
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """
+        Upper bound of bucket holding q quantile, inf if it's above last bucket.
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics(object):
+    """
+    Process-wide latency histograms and gauges, rendered as prometheus
+    text for the metrics endpoint and as short summary for /stats.
+    Observing is a lock and a bisect, cheap enough for hot path.
+    """
+    def __init__(self, prefix="bot"):
+        self.prefix = prefix
+        self.histograms = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float) -> None:
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name: str):
+        """
+        Observe time spent in with block as name histogram.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def gauge(self, name: str, func) -> None:
+        """
+        Register gauge, func is called on every render.
+        """
+        self.gauges[name] = func
+
+    def render(self) -> str:
+        """
+        Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            for name, h in sorted(self.histograms.items()):
+                metric = f"{self.prefix}_{name}_seconds"
+                lines.append(f"# TYPE {metric} histogram")
+                seen = 0
+                for bound, count in zip(h.buckets, h.counts):
+                    seen += count
+                    lines.append(f'{metric}_bucket{{le="{bound}"}} {seen}')
+                lines.append(f'{metric}_bucket{{le="+Inf"}} {h.count}')
+                lines.append(f"{metric}_sum {h.sum}")
+                lines.append(f"{metric}_count {h.count}")
+        for name, func in sorted(self.gauges.items()):
+            metric = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {func()}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """
+        Count, p50 and p99 of every histogram and gauge values.
+        """
+        lines = []
+        with self._lock:
+            for name, h in sorted(self.histograms.items()):
+                lines.append(f"{name}: n={h.count} p50<={h.quantile(0.5)}s p99<={h.quantile(0.99)}s")
+        for name, func in sorted(self.gauges.items()):
+            lines.append(f"{name}: {func()}")
+        return "\n".join(lines) or "no data yet"
+
+    async def serve_http(self, reader, writer) -> None:
+        """
+        asyncio.start_server callback, answers any request with render().
+        """
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        body = self.render().encode()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            b"Content-Length: %d\r\nConnection: close\r\n\r\n" % len(body) + body)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+metrics = Metrics()
+### end metrics
+
+### start outbound
+class TokenBucket(object):
+    """
+    Allows rate events per second on average and burst of them at once.
+    """
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        # no tokens are given out before this time, set on telegram RetryAfter
+        self.blocked_until = 0.0
+
+    def delay(self) -> float:
+        """
+        :return: seconds until next event is allowed, 0 if it is allowed now
+        """
+        now = time.monotonic()
+        # updated is in future while blocked
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        if self.blocked_until > now:
+            return self.blocked_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def block(self, seconds: float) -> None:
+        # one event is allowed when block ends, tokens refill only after it, so no burst follows
+        self.blocked_until = self.updated = time.monotonic() + seconds
+        self.tokens = 1.0
+
+    def full(self) -> bool:
+        return self.delay() == 0 and self.tokens >= self.burst
+
+
+@dataclass(slots=True)
+class OutboundMessage:
+    parts: list
+    key: Optional[str]
+    separator: str
+    kwargs: dict
+    queued: float
+
+    def text(self) -> str:
+        return self.separator.join(self.parts)
+
+
+class OutboundQueue(object):
+    """
+    Send queue of bot messages with per-chat and global token buckets,
+    for use from event loop only. Every chat with pending messages has
+    own sender task, so a chat waiting for its bucket or for telegram
+    RetryAfter doesn't hold the others. Message queued right after one
+    with the same key is merged into it while it waits.
+    """
+    def __init__(self, bot, chat_rate: float = SEND_CHAT_RATE, chat_burst: int = SEND_CHAT_BURST,
+                 global_rate: float = SEND_GLOBAL_RATE, global_burst: int = SEND_GLOBAL_BURST):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.pending = {}
+        self.buckets = {}
+        self.senders = {}
+        self.logger = logging.getLogger(__name__)
+        metrics.gauge("outbound_pending", lambda: sum(len(q) for q in self.pending.values()))
+        metrics.gauge("outbound_chats", lambda: len(self.senders))
+
+    def send(self, chat_id, text: str, key: Optional[str] = None, separator: str = "\n", **kwargs) -> None:
+        """
+        Queue message for chat.
+        :param chat_id: chat id
+        :param text: message text
+        :param key: merge with queued message of the same key, None never merges
+        :param separator: joins texts of merged messages
+        :param kwargs: send_message args, e.g. parse_mode or reply_parameters
+        """
+        queue = self.pending.setdefault(chat_id, deque())
+        last = queue[-1] if queue else None
+        if (key is not None and last is not None and last.key == key and last.kwargs == kwargs
+                and len(last.text()) + len(separator) + len(text) <= MessageLimit.MAX_TEXT_LENGTH):
+            last.parts.append(text)
+        else:
+            queue.append(OutboundMessage([text], key, separator, kwargs, time.monotonic()))
+        if chat_id not in self.senders:
+            self.senders[chat_id] = asyncio.create_task(self._sender(chat_id))
+
+    async def call(self, chat_id, func, *args, **kwargs):
+        """
+        Make telegram request whose result is needed, e.g. message to edit
+        later, after tokens of chat and global buckets like queued messages.
+        RetryAfter is waited out and request is repeated.
+        :param chat_id: chat id the request goes to
+        :param func: bot coroutine function, e.g. bot.send_message or message.edit_text
+        :param args: positional args of func
+        :param kwargs: keyword args of func
+        :return: result of func
+        """
+        while True:
+            bucket = self._bucket(chat_id)
+            await self._acquire(bucket)
+            try:
+                with metrics.timer("outbound_send"):
+                    return await func(*args, **kwargs)
+            except RetryAfter as e:
+                self._retry_after(chat_id, bucket, e)
+
+    def _bucket(self, chat_id) -> TokenBucket:
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _retry_after(self, chat_id, bucket: TokenBucket, error: RetryAfter) -> None:
+        retry_after = error.retry_after
+        if isinstance(retry_after, timedelta):
+            retry_after = retry_after.total_seconds()
+        self.logger.warning("flood limit in chat {}, retry after {}s".format(chat_id, retry_after))
+        bucket.block(retry_after)
+
+    async def _acquire(self, bucket: TokenBucket) -> None:
+        while True:
+            delay = max(bucket.delay(), self.global_bucket.delay())
+            if not delay:
+                bucket.take()
+                self.global_bucket.take()
+                return
+            await asyncio.sleep(delay)
+
+    async def _sender(self, chat_id) -> None:
+        queue = self.pending[chat_id]
+        bucket = self._bucket(chat_id)
+        try:
+            while queue:
+                await self._acquire(bucket)
+                # taken only now, messages queued while waiting could still be merged into it
+                message = queue.popleft()
+                try:
+                    with metrics.timer("outbound_send"):
+                        await self.bot.send_message(chat_id, message.text(), **message.kwargs)
+                except RetryAfter as e:
+                    self._retry_after(chat_id, bucket, e)
+                    queue.appendleft(message)
+                    continue
+                except TelegramError:
+                    self.logger.exception("failed to send message to chat {}".format(chat_id))
+                    continue
+                metrics.observe("outbound_wait", time.monotonic() - message.queued)
+        finally:
+            del self.senders[chat_id]
+            if not queue:
+                del self.pending[chat_id]
+            # full bucket is the same as a new one
+            if bucket.full() and self.buckets.get(chat_id) is bucket:
+                del self.buckets[chat_id]
+
+    async def stop(self) -> None:
+        """Cancel senders, pending messages are dropped."""
+        senders = list(self.senders.values())
+        for sender in senders:
+            sender.cancel()
+        await asyncio.gather(*senders, return_exceptions=True)
+### end outbound
+
 ### start MySQL pool
 class MySQLPool(object):
     """
     create a pool when connect mysql, which will decrease the time spent in 
     request connection, create connection and close connection.
+    Pool grows from min_size to max_size under load, shrinks back when
+    connections stay idle and queues callers when all are busy.
     """
     def __init__(self, 
     host="172.0.0.1", 
@@ -125,7 +967,12 @@ class MySQLPool(object):
     password="", 
     database="test", 
     pool_name="mypool",
-    pool_size=3):
+    min_size=MYSQL_POOL_MIN_SIZE,
+    max_size=MYSQL_POOL_MAX_SIZE,
+    timeout=MYSQL_POOL_TIMEOUT,
+    idle_timeout=MYSQL_POOL_IDLE_TIMEOUT,
+    health_check_interval=MYSQL_POOL_HEALTH_CHECK,
+    prepared_cache_size=MYSQL_PREPARED_CACHE_SIZE):
         res = {}
         self._host = host
         self._port = port
@@ -139,23 +986,189 @@ class MySQLPool(object):
         res["password"] = self._password
         res["database"] = self._database
         self.dbconfig = res
-        self.pool = self.create_pool(pool_name=pool_name, pool_size=pool_size)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.prepared_cache_size = prepared_cache_size
+        # idle connections with time they were returned, newest on the right
+        self._idle = deque()
+        self.size = 0
+        self.in_use = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+        # prepared cursors per connection, least recently used first, statement is parsed
+        # by server once per connection while it stays in cache
+        self._statements = weakref.WeakKeyDictionary()
+        for _ in range(min_size):
+            self._idle.append((self._connect(), time.monotonic()))
+            self.size += 1
+        metrics.gauge("mysql_pool_size", lambda: self.size)
+        metrics.gauge("mysql_pool_in_use", lambda: self.in_use)
+        metrics.gauge("mysql_pool_waiting", lambda: self.waiting)
+        metrics.gauge("mysql_pool_utilization", lambda: self.in_use / self.max_size)
+        # one worker per connection, so concurrent calls rarely wait for the pool
+        self.executor = ThreadPoolExecutor(max_workers=max_size, thread_name_prefix=pool_name)
+
+    def _connect(self):
+        """
+        Open new connection.
+        :return: connection
+        """
+        import mysql.connector
 
-    def create_pool(self, pool_name="mypool", pool_size=3):
+        return mysql.connector.connect(**self.dbconfig)
+
+    def _discard(self, conn):
         """
-        Create a connection pool, after created, the request of connecting 
-        MySQL could get a connection from this pool instead of request to 
-        create a connection.
-        :param pool_name: the name of pool, default is "mypool"
-        :param pool_size: the size of pool, default is 3
-        :return: connection pool
+        Close connection which won't come back to pool.
         """
-        pool = mysql.connector.pooling.MySQLConnectionPool(
-            pool_name=pool_name,
-            pool_size=pool_size,
-            pool_reset_session=True,
-            **self.dbconfig)
-        return pool
+        self._statements.pop(conn, None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _shrink(self):
+        """
+        Take connections idle for longer than idle_timeout above min_size,
+        must be called with lock held.
+        :return: connections to close
+        """
+        expired = []
+        now = time.monotonic()
+        while self._idle and self.size > self.min_size and now - self._idle[0][1] > self.idle_timeout:
+            expired.append(self._idle.popleft()[0])
+            self.size -= 1
+        return expired
+
+    def get_connection(self):
+        """
+        Take connection from pool. Idle one is reused, new one is opened
+        below max_size, otherwise wait up to timeout for a release.
+        Connection idle for longer than health_check_interval is pinged
+        and replaced if dead. Waiting time goes to mysql_pool_wait metric.
+        :return: connection, give it back with release()
+        """
+        import mysql.connector.errors
+
+        started = time.perf_counter()
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            expired = self._shrink()
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self.size < self.max_size:
+                    conn, last_used = None, None
+                    self.size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise mysql.connector.errors.PoolError(
+                        "no connection available in {}s, pool size {}".format(self.timeout, self.max_size))
+                self.waiting += 1
+                self._cond.wait(remaining)
+                self.waiting -= 1
+            self.in_use += 1
+        for c in expired:
+            self._discard(c)
+
+        try:
+            if conn is None:
+                conn = self._connect()
+            elif time.monotonic() - last_used > self.health_check_interval:
+                try:
+                    conn.ping()
+                except Exception:
+                    self._discard(conn)
+                    conn = self._connect()
+        except Exception:
+            with self._cond:
+                self.size -= 1
+                self.in_use -= 1
+                self._cond.notify()
+            raise
+        metrics.observe("mysql_pool_wait", time.perf_counter() - started)
+        return conn
+
+    def release(self, conn, broken=False):
+        """
+        Return connection to pool. Open transaction is rolled back
+        instead of resetting the whole session, so prepared statements stay.
+        :param conn: connection from get_connection()
+        :param broken: close connection instead of reusing it
+        """
+        if not broken:
+            try:
+                if conn.in_transaction:
+                    conn.rollback()
+            except Exception:
+                broken = True
+        with self._cond:
+            self.in_use -= 1
+            if broken:
+                self.size -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+        if broken:
+            self._discard(conn)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Run several statements on one connection in one transaction,
+        commit on exit or rollback on exception.
+        :return: connection
+        """
+        conn = self.get_connection()
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            # connection is gone if it can't roll back, its prepared statements too
+            broken = not self._rollback(conn)
+            raise
+        finally:
+            self.release(conn, broken)
+
+    def _rollback(self, conn) -> bool:
+        """
+        Roll back after failed statement.
+        :return: False if connection is unusable
+        """
+        try:
+            conn.rollback()
+        except Exception:
+            return False
+        return True
+
+    def prepared(self, conn, sql):
+        """
+        Return server-side prepared cursor for sql on this connection,
+        statement is prepared on first use and reused afterwards.
+        sql contains chat table name, so only prepared_cache_size recent
+        statements are kept, evicted ones are deallocated on server.
+        :param conn: connection from transaction()
+        :param sql: sql clause with %s placeholders
+        :return: prepared cursor, run it with cursor.execute(sql, args)
+        """
+        statements = self._statements.get(conn)
+        if statements is None:
+            statements = self._statements[conn] = OrderedDict()
+        cursor = statements.get(sql)
+        if cursor is not None:
+            statements.move_to_end(sql)
+            return cursor
+        cursor = statements[sql] = conn.cursor(prepared=True)
+        while len(statements) > self.prepared_cache_size:
+            _, evicted = statements.popitem(last=False)
+            evicted.close()
+        return cursor
 
     def close(self, conn, cursor):
         """
@@ -165,7 +1178,7 @@ class MySQLPool(object):
         :return: 
         """
         cursor.close()
-        conn.close()
+        self.release(conn)
 
     def execute(self, sql, args=None, commit=False):
         """
@@ -177,20 +1190,24 @@ class MySQLPool(object):
         :return: if commit, return None, else, return result
         """
         # get connection form connection pool instead of create one.
-        conn = self.pool.get_connection()
-        cursor = conn.cursor()
-        if args:
-            cursor.execute(sql, args)
-        else:
-            cursor.execute(sql)
-        if commit is True:
-            conn.commit()
-            self.close(conn, cursor)
-            return None
-        else:
-            res = cursor.fetchall()
-            self.close(conn, cursor)
-            return res
+        conn = self.get_connection()
+        try:
+            cursor = conn.cursor()
+            if args:
+                cursor.execute(sql, args)
+            else:
+                cursor.execute(sql)
+            if commit is True:
+                conn.commit()
+                res = None
+            else:
+                res = cursor.fetchall()
+        except Exception:
+            # connection goes back to pool in any case, closed when it can't roll back
+            self.release(conn, broken=not self._rollback(conn))
+            raise
+        self.close(conn, cursor)
+        return res
 
     def executemany(self, sql, args, commit=False):
         """
@@ -202,23 +1219,816 @@ class MySQLPool(object):
         :return: if commit, return None, else, return result
         """
         # get connection form connection pool instead of create one.
-        conn = self.pool.get_connection()
-        cursor = conn.cursor()
-        cursor.executemany(sql, args)
-        if commit is True:
-            conn.commit()
-            self.close(conn, cursor)
-            return None
-        else:
-            res = cursor.fetchall()
-            self.close(conn, cursor)
-            return res
+        conn = self.get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.executemany(sql, args)
+            if commit is True:
+                conn.commit()
+                res = None
+            else:
+                res = cursor.fetchall()
+        except Exception:
+            self.release(conn, broken=not self._rollback(conn))
+            raise
+        self.close(conn, cursor)
+        return res
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Run blocking function which uses the pool in the pool executor, so it
+        doesn't block event loop.
+        :param func: function to call
+        :param args: positional args of func
+        :param kwargs: keyword args of func
+        :return: result of func
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
 
 ### end MySQL pool
 
-class Imagebot():
+### start hash stores
+class HashStore(object):
+    """
+    Durable storage of chat hashes, table is chat table name from
+    Imagebot.tg_to_sql_chat_name. Methods are blocking, call them
+    through run() from async code.
+    """
+    executor = None
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Run blocking function in store executor, so it doesn't block event loop.
+        :param func: function to call
+        :param args: positional args of func
+        :param kwargs: keyword args of func
+        :return: result of func
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    def tables(self) -> list:
+        """
+        :return: names of existing tables
+        """
+        raise NotImplementedError
+
+    def has_table(self, table: str) -> bool:
+        raise NotImplementedError
+
+    def init_table(self, table: str) -> None:
+        raise NotImplementedError
+
+    def load(self, table: str, after: Optional[int] = None):
+        """
+        :param table: table name
+        :param after: only messages with greater id
+        :return: iterable of (message_id, hash) ordered by message_id
+        """
+        raise NotImplementedError
+
+    def scan(self, table: str, value: int, sc: int) -> list:
+        """
+        Find messages with hash not further than sc without in-memory index.
+        :param table: table name
+        :param value: hash
+        :param sc: hamming radius
+        :return: message ids
+        """
+        raise NotImplementedError
+
+    def scan_many(self, table: str, values: list, sc: int) -> list:
+        """
+        Batch scan(), all hashes are looked up with one pass over table.
+        :param table: table name
+        :param values: hashes
+        :param sc: hamming radius
+        :return: message ids for every hash
+        """
+        return [self.scan(table, value, sc) for value in values]
+
+    def insert(self, table: str, message_id: int, value: int, file_unique_id: Optional[str] = None) -> None:
+        """
+        Insert hash, with telegram file of the message in the same commit.
+        :param table: table name
+        :param message_id: message id
+        :param value: hash
+        :param file_unique_id: telegram file_unique_id for put_file()
+        """
+        raise NotImplementedError
+
+    def insert_many(self, table: str, rows, files=()) -> None:
+        """
+        Insert several hashes and telegram files with one commit.
+        :param table: table name
+        :param rows: iterable of (message_id, hash)
+        :param files: iterable of (file_unique_id, message_id, hash) for put_file()
+        """
+        for message_id, value in rows:
+            self.insert(table, message_id, value)
+        for file_unique_id, message_id, value in files:
+            self.put_file(table, file_unique_id, message_id, value)
+
+    def get_file(self, table: str, file_unique_id: str) -> Optional[Tuple[int, int]]:
+        """
+        Find message which already had this telegram file.
+        :param table: table name
+        :param file_unique_id: telegram file_unique_id
+        :return: (message_id, hash) or None
+        """
+        raise NotImplementedError
+
+    def get_files(self, table: str, file_unique_ids: list) -> dict:
+        """
+        Batch get_file().
+        :param table: table name
+        :param file_unique_ids: telegram file_unique_ids
+        :return: file_unique_id -> (message_id, hash) for known files
+        """
+        files = {}
+        for file_unique_id in file_unique_ids:
+            row = self.get_file(table, file_unique_id)
+            if row:
+                files[file_unique_id] = row
+        return files
+
+    def put_file(self, table: str, file_unique_id: str, message_id: int, value: int) -> None:
+        """
+        Remember message for telegram file, existing record is kept.
+        """
+        raise NotImplementedError
+
+    def check_and_insert(self, table: str, message_id: int, value: int, sc: int, file_unique_id: Optional[str] = None) -> list:
+        """
+        Find messages with hash not further than sc, insert hash if nothing found.
+        :param table: table name
+        :param message_id: message id
+        :param value: hash
+        :param sc: hamming radius
+        :param file_unique_id: telegram file_unique_id, remembered for first similar message or this one
+        :return: message ids of similar images
+        """
+        with metrics.timer("image_lookup"):
+            res = self.scan(table, value, sc)
+        if not res:
+            with metrics.timer("image_insert"):
+                self.insert(table, message_id, value, file_unique_id)
+        elif file_unique_id:
+            with metrics.timer("image_insert"):
+                self.put_file(table, file_unique_id, res[0], value)
+        return res
+
+    def expired(self, table: str, max_age_days: Optional[int] = None, max_rows: Optional[int] = None) -> list:
+        """
+        Find messages out of retention policy.
+        :param table: table name
+        :param max_age_days: rows stored more than this many days ago
+        :param max_rows: rows beyond this many newest ones, message ids grow within a chat
+        :return: sorted message ids
+        """
+        raise NotImplementedError
+
+    def delete(self, table: str, message_ids) -> list:
+        """
+        Delete hashes and telegram files of messages with one commit.
+        :param table: table name
+        :param message_ids: message ids
+        :return: file_unique_ids of deleted telegram files
+        """
+        raise NotImplementedError
+
+    def merge(self, table: str, message_id: int, merged_ids) -> None:
+        """
+        Fold rows of merged_ids into row of message_id, which keeps their
+        ids (and ids they kept before) as aliases; merged rows are deleted.
+        :param table: table name
+        :param message_id: message id of kept row
+        :param merged_ids: message ids of near-identical rows
+        """
+        raise NotImplementedError
+
+    def generation(self, table: str) -> int:
+        """
+        Number of changes to table other than inserts of messages newer than
+        all stored ones, delete() and merge() bump it.
+        :param table: table name
+        :return: generation, 0 for never changed table
+        """
+        raise NotImplementedError
+
+    def bump_generation(self, table: str) -> None:
+        """
+        Mark table changed, e.g. after inserting older messages.
+        :param table: table name
+        """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """
+        Release store resources on shutdown, waits for running store calls.
+        """
+
+
+class MySQLHashStore(HashStore):
+    """
+    Hashes in per-chat mysql tables of table_structure.
+    """
     def __init__(self, mysql_pool):
         self.mysql_pool = mysql_pool
+        self.executor = mysql_pool.executor
+        self.logger = logging.getLogger(__name__)
+        # process-wide known tables, photo in known chat doesn't ask mysql whether its table exists
+        self.known_tables = set()
+        self.tables()
+        if file_ids_table not in self.known_tables:
+            self.init_table(file_ids_table, file_ids_structure)
+        if generations_table not in self.known_tables:
+            self.init_table(generations_table, generations_structure)
+
+    def tables(self) -> list:
+        """
+        Read table names from information_schema and refresh known tables cache.
+        :return: names of chat tables
+        """
+        rows = self.mysql_pool.execute(
+            "SELECT TABLE_NAME FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE();")
+        self.known_tables = {r[0] for r in rows or ()}
+        return [t for t in self.known_tables if t.startswith(table_prefix)]
+
+    def has_table(self, table: str) -> bool:
+        return table in self.known_tables
+
+    def init_table(self, table_name: str, structure: str = table_structure) -> None:
+        self.mysql_pool.execute(f"CREATE TABLE IF NOT EXISTS `{table_name}` {structure}", commit=True)
+        self.known_tables.add(table_name)
+        self.logger.info("created table {}".format(table_name))
+
+    def load(self, table: str, after: Optional[int] = None):
+        if after is None:
+            rows = self.mysql_pool.execute(f"SELECT `message_id`, H0, H1 FROM `{table}` ORDER BY `message_id`;")
+        else:
+            rows = self.mysql_pool.execute(
+                f"SELECT `message_id`, H0, H1 FROM `{table}` WHERE `message_id` > %s ORDER BY `message_id`;", (after,))
+        return [(message_id, join_hash(h0, h1)) for message_id, h0, h1 in rows or ()]
+
+    def scan(self, table: str, value: int, sc: int) -> list:
+        h0, h1 = split_hash(value)
+        s_statement = f"SELECT `message_id` FROM `{table}` WHERE BIT_COUNT(H0 ^ %s) + BIT_COUNT(H1 ^ %s) <= %s"
+        with self.mysql_pool.transaction() as conn:
+            cursor = self.mysql_pool.prepared(conn, s_statement)
+            cursor.execute(s_statement, (h0, h1, sc))
+            return [r[0] for r in cursor.fetchall()]
+
+    def scan_many(self, table: str, values: list, sc: int) -> list:
+        if not values:
+            return []
+        # one SELECT for all hashes, rows are assigned to hashes they are close to here
+        where = " OR ".join(["BIT_COUNT(H0 ^ %s) + BIT_COUNT(H1 ^ %s) <= %s"] * len(values))
+        args = [arg for value in values for arg in (*split_hash(value), sc)]
+        rows = self.mysql_pool.execute(f"SELECT `message_id`, H0, H1 FROM `{table}` WHERE {where} ORDER BY `message_id`", args)
+        rows = [(message_id, join_hash(h0, h1)) for message_id, h0, h1 in rows or ()]
+        return [[message_id for message_id, h in rows if (h ^ value).bit_count() <= sc] for value in values]
+
+    def insert(self, table: str, message_id: int, value: int, file_unique_id: Optional[str] = None) -> None:
+        ins = f"INSERT INTO `{table}` (message_id, H0, H1) VALUES (%s, %s, %s)"
+        h0, h1 = split_hash(value)
+        with self.mysql_pool.transaction() as conn:
+            self.mysql_pool.prepared(conn, ins).execute(ins, (message_id, h0, h1))
+            if file_unique_id:
+                self.mysql_pool.prepared(conn, ins_file).execute(ins_file, (table, file_unique_id, message_id, h0, h1))
+
+    def insert_many(self, table: str, rows, files=()) -> None:
+        # executemany turns each into one multi-row INSERT, both group committed
+        ins = f"INSERT INTO `{table}` (message_id, H0, H1) VALUES (%s, %s, %s)"
+        args = [(message_id, *split_hash(value)) for message_id, value in rows]
+        files_args = [(table, file_unique_id, message_id, *split_hash(value)) for file_unique_id, message_id, value in files]
+        if not args and not files_args:
+            return
+        with self.mysql_pool.transaction() as conn:
+            cursor = conn.cursor()
+            if args:
+                cursor.executemany(ins, args)
+            if files_args:
+                cursor.executemany(ins_file, files_args)
+            cursor.close()
+
+    def get_file(self, table: str, file_unique_id: str) -> Optional[Tuple[int, int]]:
+        s_statement = f"SELECT `message_id`, H0, H1 FROM `{file_ids_table}` WHERE chat_table = %s AND file_unique_id = %s"
+        with self.mysql_pool.transaction() as conn:
+            cursor = self.mysql_pool.prepared(conn, s_statement)
+            cursor.execute(s_statement, (table, file_unique_id))
+            rows = cursor.fetchall()
+        if rows:
+            message_id, h0, h1 = rows[0]
+            return message_id, join_hash(h0, h1)
+        return None
+
+    def get_files(self, table: str, file_unique_ids: list) -> dict:
+        if not file_unique_ids:
+            return {}
+        placeholders = ", ".join(["%s"] * len(file_unique_ids))
+        rows = self.mysql_pool.execute(
+            f"SELECT file_unique_id, `message_id`, H0, H1 FROM `{file_ids_table}` "
+            f"WHERE chat_table = %s AND file_unique_id IN ({placeholders})", (table, *file_unique_ids))
+        return {file_unique_id: (message_id, join_hash(h0, h1)) for file_unique_id, message_id, h0, h1 in rows or ()}
+
+    def put_file(self, table: str, file_unique_id: str, message_id: int, value: int) -> None:
+        with self.mysql_pool.transaction() as conn:
+            self.mysql_pool.prepared(conn, ins_file).execute(ins_file, (table, file_unique_id, message_id, *split_hash(value)))
+
+    def check_and_insert(self, table: str, message_id: int, value: int, sc: int, file_unique_id: Optional[str] = None) -> list:
+        # lookup, insert and telegram file share one connection, one transaction and prepared statements
+        h0, h1 = split_hash(value)
+        s_statement = f"SELECT `message_id` FROM `{table}` WHERE BIT_COUNT(H0 ^ %s) + BIT_COUNT(H1 ^ %s) <= %s"
+        ins = f"INSERT INTO `{table}` (message_id, H0, H1) VALUES (%s, %s, %s)"
+        insert_started = None
+        with self.mysql_pool.transaction() as conn:
+            with metrics.timer("image_lookup"):
+                cursor = self.mysql_pool.prepared(conn, s_statement)
+                cursor.execute(s_statement, (h0, h1, sc))
+                res = [r[0] for r in cursor.fetchall()]
+            if not res or file_unique_id:
+                insert_started = time.perf_counter()
+            if not res:
+                self.mysql_pool.prepared(conn, ins).execute(ins, (message_id, h0, h1))
+            if file_unique_id:
+                self.mysql_pool.prepared(conn, ins_file).execute(
+                    ins_file, (table, file_unique_id, res[0] if res else message_id, h0, h1))
+        # image_insert includes commit
+        if insert_started is not None:
+            metrics.observe("image_insert", time.perf_counter() - insert_started)
+        return res
+
+    def expired(self, table: str, max_age_days: Optional[int] = None, max_rows: Optional[int] = None) -> list:
+        ids = set()
+        if max_age_days:
+            rows = self.mysql_pool.execute(
+                f"SELECT `message_id` FROM `{table}` WHERE created_at < NOW() - INTERVAL %s DAY", (max_age_days,))
+            ids.update(r[0] for r in rows or ())
+        if max_rows:
+            # mysql has no OFFSET without LIMIT, max unsigned bigint stands for "all"
+            rows = self.mysql_pool.execute(
+                f"SELECT `message_id` FROM `{table}` ORDER BY `message_id` DESC LIMIT 18446744073709551615 OFFSET %s", (max_rows,))
+            ids.update(r[0] for r in rows or ())
+        return sorted(ids)
+
+    def delete(self, table: str, message_ids) -> list:
+        message_ids = list(message_ids)
+        files = []
+        if not message_ids:
+            return files
+        with self.mysql_pool.transaction() as conn:
+            cursor = conn.cursor()
+            for k in range(0, len(message_ids), COMPACTION_BATCH):
+                chunk = message_ids[k:k + COMPACTION_BATCH]
+                placeholders = ", ".join(["%s"] * len(chunk))
+                cursor.execute(f"DELETE FROM `{table}` WHERE `message_id` IN ({placeholders})", chunk)
+                cursor.execute(f"SELECT file_unique_id FROM `{file_ids_table}` WHERE chat_table = %s AND `message_id` IN ({placeholders})",
+                               (table, *chunk))
+                files.extend(r[0] for r in cursor.fetchall())
+                cursor.execute(f"DELETE FROM `{file_ids_table}` WHERE chat_table = %s AND `message_id` IN ({placeholders})",
+                               (table, *chunk))
+            cursor.execute(bump_generation, (table,))
+            cursor.close()
+        return files
+
+    def merge(self, table: str, message_id: int, merged_ids) -> None:
+        merged_ids = list(merged_ids)
+        if not merged_ids:
+            return
+        placeholders = ", ".join(["%s"] * len(merged_ids))
+        with self.mysql_pool.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT alias_ids FROM `{table}` WHERE `message_id` IN (%s, {placeholders})",
+                           (message_id, *merged_ids))
+            aliases = set(merged_ids)
+            for (alias_ids,) in cursor.fetchall():
+                if alias_ids:
+                    aliases.update(int(a) for a in alias_ids.split(","))
+            cursor.execute(f"UPDATE `{table}` SET alias_ids = %s WHERE `message_id` = %s",
+                           (",".join(map(str, sorted(aliases))), message_id))
+            cursor.execute(f"DELETE FROM `{table}` WHERE `message_id` IN ({placeholders})", merged_ids)
+            cursor.execute(bump_generation, (table,))
+            cursor.close()
+
+    def generation(self, table: str) -> int:
+        rows = self.mysql_pool.execute(f"SELECT generation FROM `{generations_table}` WHERE chat_table = %s", (table,))
+        return rows[0][0] if rows else 0
+
+    def bump_generation(self, table: str) -> None:
+        self.mysql_pool.execute(bump_generation, (table,), commit=True)
+
+    def migrate_tables(self) -> None:
+        """
+        Convert legacy A0..A3 chat tables to H0/H1 schema.
+        Hash halves are rebuilt with bit shifts inside mysql in a single
+        INSERT ... SELECT, old table is kept as legacy_<table>.
+        H0/H1 tables without created_at/alias_ids get these columns,
+        their existing rows are dated by migration time.
+        """
+        tables = self.mysql_pool.execute(
+            "SELECT TABLE_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND COLUMN_NAME = 'A0';")
+        high, low = legacy_hash_sql()
+        for (table,) in tables or ():
+            if not table_algorithm(table):
+                continue
+            new_table = f"{table}_migrate"
+            self.mysql_pool.execute(f"CREATE TABLE `{new_table}` {table_structure}", commit=True)
+            self.mysql_pool.execute(
+                f"INSERT INTO `{new_table}` (message_id, H0, H1) SELECT message_id, {high}, {low} FROM `{table}` "
+                f"WHERE A0 IS NOT NULL AND A1 IS NOT NULL AND A2 IS NOT NULL AND A3 IS NOT NULL;", commit=True)
+            self.mysql_pool.execute(f"RENAME TABLE `{table}` TO `legacy_{table}`, `{new_table}` TO `{table}`;", commit=True)
+            self.logger.info("migrated table {}".format(table))
+        tables = self.mysql_pool.execute(
+            "SELECT TABLE_NAME FROM information_schema.TABLES t WHERE TABLE_SCHEMA = DATABASE() AND NOT EXISTS "
+            "(SELECT 1 FROM information_schema.COLUMNS c WHERE c.TABLE_SCHEMA = t.TABLE_SCHEMA "
+            "AND c.TABLE_NAME = t.TABLE_NAME AND c.COLUMN_NAME = 'created_at');")
+        for (table,) in tables or ():
+            if not table_algorithm(table):
+                continue
+            self.mysql_pool.execute(
+                f"ALTER TABLE `{table}` ADD COLUMN `created_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP, "
+                f"ADD COLUMN `alias_ids` text DEFAULT NULL;", commit=True)
+            self.logger.info("added retention columns to {}".format(table))
+
+
+class RocksHashStore(HashStore):
+    """
+    Hashes in embedded RocksDB, no network round trip for single node setup.
+    Key is table name, ':' and big-endian message_id, so a table is a
+    sorted key range; value is 16 bytes of hash, 8 bytes of unix time it
+    was stored (missing or 0 when unknown) and 8 bytes per alias message
+    id kept by compaction. Table generation is under '%' and table name.
+    Tables are registered
+    under '!' and table name, which sorts before any chat table. Telegram
+    files are kept under '#', table name, ':' and file_unique_id.
+    """
+    def __init__(self, path=ROCKSDB_PATH, workers=4):
+        from rocksdict import Rdict
+
+        self.db = Rdict(path)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rocksdb")
+
+    def _prefix(self, table: str) -> bytes:
+        return f"{table}:".encode()
+
+    def _range(self, prefix: bytes, start: bytes = b""):
+        for key, value in self.db.items(from_key=prefix + start):
+            if not key.startswith(prefix):
+                break
+            yield key[len(prefix):], value
+
+    def tables(self) -> list:
+        return [key.decode() for key, _ in self._range(b"!")]
+
+    def has_table(self, table: str) -> bool:
+        return f"!{table}".encode() in self.db
+
+    def init_table(self, table: str) -> None:
+        self.db[f"!{table}".encode()] = b""
+
+    def _pack(self, value: int, created: Optional[int] = None, aliases=()) -> bytes:
+        if created is None:
+            created = int(time.time())
+        return value.to_bytes(16, "big") + created.to_bytes(8, "big") + b"".join(a.to_bytes(8, "big") for a in aliases)
+
+    def _aliases(self, packed: bytes) -> list:
+        return [int.from_bytes(packed[k:k + 8], "big") for k in range(24, len(packed), 8)]
+
+    def load(self, table: str, after: Optional[int] = None):
+        start = b"" if after is None else (after + 1).to_bytes(8, "big")
+        for key, value in self._range(self._prefix(table), start):
+            yield int.from_bytes(key, "big"), int.from_bytes(value[:16], "big")
+
+    def scan(self, table: str, value: int, sc: int) -> list:
+        return [m for m, h in self.load(table) if (h ^ value).bit_count() <= sc]
+
+    def scan_many(self, table: str, values: list, sc: int) -> list:
+        results = [[] for _ in values]
+        for m, h in self.load(table):
+            for res, value in zip(results, values):
+                if (h ^ value).bit_count() <= sc:
+                    res.append(m)
+        return results
+
+    def insert(self, table: str, message_id: int, value: int, file_unique_id: Optional[str] = None) -> None:
+        if file_unique_id:
+            self.insert_many(table, [(message_id, value)], [(file_unique_id, message_id, value)])
+        else:
+            self.db[self._prefix(table) + message_id.to_bytes(8, "big")] = self._pack(value)
+
+    def insert_many(self, table: str, rows, files=()) -> None:
+        from rocksdict import WriteBatch
+
+        batch = WriteBatch()
+        for message_id, value in rows:
+            batch.put(self._prefix(table) + message_id.to_bytes(8, "big"), self._pack(value))
+        for file_unique_id, message_id, value in files:
+            key = self._file_key(table, file_unique_id)
+            if key not in self.db:
+                batch.put(key, message_id.to_bytes(8, "big") + value.to_bytes(16, "big"))
+        self.db.write(batch)
+
+    def _file_key(self, table: str, file_unique_id: str) -> bytes:
+        return f"#{table}:{file_unique_id}".encode()
+
+    def get_file(self, table: str, file_unique_id: str) -> Optional[Tuple[int, int]]:
+        value = self.db.get(self._file_key(table, file_unique_id))
+        if value is None:
+            return None
+        return int.from_bytes(value[:8], "big"), int.from_bytes(value[8:], "big")
+
+    def put_file(self, table: str, file_unique_id: str, message_id: int, value: int) -> None:
+        key = self._file_key(table, file_unique_id)
+        if key not in self.db:
+            self.db[key] = message_id.to_bytes(8, "big") + value.to_bytes(16, "big")
+
+    def expired(self, table: str, max_age_days: Optional[int] = None, max_rows: Optional[int] = None) -> list:
+        rows = [(int.from_bytes(key, "big"), int.from_bytes(value[16:24], "big"))
+                for key, value in self._range(self._prefix(table))]
+        ids = set()
+        if max_age_days:
+            cutoff = time.time() - max_age_days * 86400
+            ids.update(message_id for message_id, created in rows if created and created < cutoff)
+        if max_rows and len(rows) > max_rows:
+            # keys are sorted by message id, oldest first
+            ids.update(message_id for message_id, _ in rows[:len(rows) - max_rows])
+        return sorted(ids)
+
+    def delete(self, table: str, message_ids) -> list:
+        from rocksdict import WriteBatch
+
+        message_ids = set(message_ids)
+        files = []
+        if not message_ids:
+            return files
+        batch = WriteBatch()
+        for message_id in message_ids:
+            batch.delete(self._prefix(table) + message_id.to_bytes(8, "big"))
+        files_prefix = f"#{table}:".encode()
+        for file_unique_id, value in self._range(files_prefix):
+            if int.from_bytes(value[:8], "big") in message_ids:
+                batch.delete(files_prefix + file_unique_id)
+                files.append(file_unique_id.decode())
+        self._bump(batch, table)
+        self.db.write(batch)
+        return files
+
+    def merge(self, table: str, message_id: int, merged_ids) -> None:
+        from rocksdict import WriteBatch
+
+        key = self._prefix(table) + message_id.to_bytes(8, "big")
+        packed = self.db.get(key)
+        if packed is None:
+            return
+        aliases = set(self._aliases(packed))
+        batch = WriteBatch()
+        for merged_id in merged_ids:
+            merged_key = self._prefix(table) + merged_id.to_bytes(8, "big")
+            merged = self.db.get(merged_key)
+            if merged is not None:
+                aliases.add(merged_id)
+                aliases.update(self._aliases(merged))
+                batch.delete(merged_key)
+        batch.put(key, self._pack(int.from_bytes(packed[:16], "big"), int.from_bytes(packed[16:24], "big"), sorted(aliases)))
+        self._bump(batch, table)
+        self.db.write(batch)
+
+    def _bump(self, batch, table: str) -> None:
+        batch.put(f"%{table}".encode(), (self.generation(table) + 1).to_bytes(8, "big"))
+
+    def generation(self, table: str) -> int:
+        value = self.db.get(f"%{table}".encode())
+        return int.from_bytes(value, "big") if value is not None else 0
+
+    def bump_generation(self, table: str) -> None:
+        from rocksdict import WriteBatch
+
+        batch = WriteBatch()
+        self._bump(batch, table)
+        self.db.write(batch)
+
+    def close(self) -> None:
+        # database is flushed and its lock released, next process can open it
+        self.executor.shutdown()
+        self.db.close()
+
+
+def create_store() -> HashStore:
+    """Create hash store selected by STORAGE_BACKEND."""
+    if STORAGE_BACKEND == "rocksdb":
+        return RocksHashStore(ROCKSDB_PATH)
+    return MySQLHashStore(MySQLPool(**DBCONFIG))
+### end hash stores
+
+### start sharding
+class HashRing(object):
+    """
+    Consistent hash ring of shard worker addresses with virtual nodes,
+    adding or removing a worker moves only chats of its part of the ring.
+    Chats are keyed by abs(chat id), so owner is known from table name too.
+    """
+    def __init__(self, nodes, vnodes=SHARD_VNODES):
+        self._ring = sorted((self._hash(f"{node}#{i}"), node) for node in nodes for i in range(vnodes))
+        self._keys = [k for k, _ in self._ring]
+
+    @staticmethod
+    def _hash(key) -> int:
+        return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], "big")
+
+    def node(self, chat_id) -> str:
+        """
+        :param chat_id: chat id, sign is ignored
+        :return: address of worker owning chat
+        """
+        i = bisect.bisect(self._keys, self._hash(abs(int(chat_id)))) % len(self._keys)
+        return self._ring[i][1]
+
+
+async def open_shard_connection(address: str, retries: int = 20):
+    """
+    Connect to shard worker, address is unix:<path> or <host>:<port>.
+    Retries while worker is starting.
+    :return: (reader, writer)
+    """
+    for attempt in range(retries):
+        try:
+            if address.startswith("unix:"):
+                return await asyncio.open_unix_connection(address[len("unix:"):])
+            host, _, port = address.rpartition(":")
+            return await asyncio.open_connection(host, int(port))
+        except OSError:
+            if attempt == retries - 1:
+                raise
+            await asyncio.sleep(0.5)
+
+
+async def start_shard_server(address: str, callback):
+    """
+    Listen for ingress on unix:<path> or <host>:<port>.
+    """
+    if address.startswith("unix:"):
+        path = address[len("unix:"):]
+        if os.path.exists(path):
+            os.remove(path)
+        return await asyncio.start_unix_server(callback, path)
+    host, _, port = address.rpartition(":")
+    return await asyncio.start_server(callback, host, int(port))
+
+
+class ShardIngress(object):
+    """
+    Receives updates and forwards each to the worker owning its chat.
+    Updates go as 4 byte big-endian length and update JSON over a single
+    stream per worker, so updates of one chat arrive in order.
+    """
+    def __init__(self, addresses):
+        self.ring = HashRing(addresses)
+        self.writers = {}
+        self.logger = logging.getLogger(__name__)
+
+    async def forward(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        chat = update.effective_chat
+        address = self.ring.node(chat.id if chat else 0)
+        writer = self.writers.get(address)
+        if writer is None or writer.is_closing():
+            _, writer = await open_shard_connection(address)
+            self.writers[address] = writer
+        data = json.dumps(update.to_dict()).encode()
+        writer.write(len(data).to_bytes(4, "big") + data)
+        await writer.drain()
+
+    def main(self, bot_api_url: str = None, **kwargs) -> None:
+        """Receive updates, takes same arguments as run_application."""
+        builder = Application.builder().token(TOKEN)
+        if bot_api_url:
+            builder = builder.base_url(f"{bot_api_url}/bot").base_file_url(f"{bot_api_url}/file/bot")
+        application = builder.build()
+        application.add_handler(TypeHandler(Update, self.forward))
+        run_application(application, **kwargs)
+
+
+def shard_worker_main(address: str, addresses: list, index: int = 0, bot_api_url: str = None) -> None:
+    """
+    Run bot worker which gets updates of its chats from ingress.
+    :param address: address to listen on, one of addresses
+    :param addresses: all worker addresses, worker preloads and compacts only its own chats
+    :param index: worker number, metrics port is METRICS_PORT + 1 + index
+    :param bot_api_url: Bot API server
+    """
+    if address not in addresses:
+        raise ValueError("worker address {} is not in shard addresses {}".format(address, addresses))
+    ib = Imagebot(create_store(), HashWorkerPool(workers=max(1, HASH_WORKERS // len(addresses))),
+                  metrics_port=METRICS_PORT + 1 + index if METRICS_PORT else None)
+    ring = HashRing(addresses)
+    ib.owns = lambda table: ring.node(table.partition('_')[0][len(table_prefix):]) == address
+    if SIMILARITY_ENGINE in ("index", "numpy"):
+        ib.load_hash_indexes(owns=ib.owns)
+    try:
+        asyncio.run(ib.run_shard_worker(address, bot_api_url))
+    except KeyboardInterrupt:
+        pass
+
+
+def run_shards(shards: int, bot_api_url: str = None, **kwargs) -> None:
+    """
+    Run ingress in this process and shards local worker processes on unix sockets.
+    """
+    addresses = [f"unix:{SHARD_SOCKET_DIR}/bruhbot-shard{i}.sock" for i in range(shards)]
+    # not daemonic, daemonic process can't start its hash worker processes
+    processes = [multiprocessing.Process(target=shard_worker_main, args=(address, addresses, i, bot_api_url))
+                 for i, address in enumerate(addresses)]
+    for process in processes:
+        process.start()
+    try:
+        ShardIngress(addresses).main(bot_api_url=bot_api_url, **kwargs)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+### end sharding
+
+def run_application(application: Application, webhook_url:str=None, listen:str="0.0.0.0", port:int=8443, secret_token:str=None) -> None:
+    """Receive updates with webhook if webhook_url is set or long polling."""
+    if webhook_url:
+        application.run_webhook(
+            listen=listen,
+            port=port,
+            url_path=urlsplit(webhook_url).path.lstrip('/'),
+            webhook_url=webhook_url,
+            secret_token=secret_token,
+            allowed_updates=Update.ALL_TYPES)
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Process updates concurrently, but one at a time per chat, so replies in
+    a chat keep their order while different chats run in parallel.
+    Semaphore of BaseUpdateProcessor admits up to max_pending_updates,
+    admitted update takes its chat lock before one of max_concurrent_updates
+    slots, so updates queued behind a busy chat don't hold slots of other chats.
+    """
+    def __init__(self, max_concurrent_updates: int, max_pending_updates: int = PENDING_UPDATES):
+        super().__init__(max(max_pending_updates, max_concurrent_updates))
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        # chat id -> [lock, updates holding or waiting for it], dropped when last one is done
+        self._locks = {}
+        metrics.gauge("updates_pending", lambda: self.current_concurrent_updates)
+
+    async def do_process_update(self, update, coroutine) -> None:
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._slots:
+                await coroutine
+            return
+        entry = self._locks.get(chat.id)
+        if entry is None:
+            entry = self._locks[chat.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._slots:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[chat.id]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+class Imagebot():
+    def __init__(self, store, hash_pool=None, metrics_port=METRICS_PORT):
+        self.store = store
+        self.metrics_port = metrics_port
+        self.hash_pool = hash_pool or HashWorkerPool()
+        self.hash_indexes = {}
+        self.table_locks = {}
+        # (table, file_unique_id) -> message id with this file
+        self.file_ids = LRUCache(FILE_ID_CACHE_SIZE)
+        # media_group_id -> messages waiting for album window
+        self.albums = {}
+        # shared keep-alive http client, created in post_init
+        self.http = None
+        self.weather_cache = TTLCache(ttl=WEATHER_CACHE_TTL)
+        # openai client, created on first /gpt
+        self.gpt = None
+        self.gpt_semaphore = None
+        self.gpt_chat_semaphores = {}
+        self.gpt_cache = LRUCache(GPT_CACHE_SIZE) if GPT_CACHE_SIZE else None
+        self.metrics_server = None
+        # rate limited send queue, created in post_init
+        self.outbound = None
+        # table filter of shard worker, None when this process serves all chats
+        self.owns = None
+        self.compaction_task = None
 
         logging.basicConfig(
             format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -226,60 +2036,343 @@ class Imagebot():
         logging.getLogger("httpx").setLevel(logging.WARNING)
         self.logger = logging.getLogger(__name__)
 
-    def tg_to_sql_chat_name(self, chat:str) -> str:
+    def tg_to_sql_chat_name(self, chat:str, algorithm:str=DEFAULT_HASH_ALGORITHM) -> str:
         """Convert chat name to usable format for mysql.
+        Hashes of different algorithms can't be compared, so every
+        algorithm except ahash gets own table with suffix.
 
         Args:
             chat (str): chat id
+            algorithm (str, optional): hash algorithm.
 
         Returns:
             str: db name
         """
-        return f"{table_prefix}{chat.replace('-','')}"
+        table = f"{table_prefix}{chat.replace('-','')}"
+        if algorithm != "ahash":
+            table = f"{table}_{algorithm}"
+        return table
 
     def mysql_init_table(self, table_name:str) -> None:
         """This method will create table for chat if not exists.
 
         Args:
-            table_name (str): mysql table name
+            table_name (str): table name
         """
-        tables = self.mysql_pool.execute("SHOW TABLES;")
-        if tables:
-            for t in tables:
-                if table_name in t:
-                    self.logger.info("existing tables: {}".format(table_name))
-                else:
-                    try:
-                        self.mysql_pool.execute(f"CREATE TABLE `{table_name}` {table_structure}")
-                    except Exception as e:
-                        self.logger.error(e)
+        self.store.init_table(table_name)
+
+    def get_hash_index(self, table: str) -> HashIndex:
+        """Return in-memory index for table, load it from store on first use.
+
+        Args:
+            table (str): table name
+
+        Returns:
+            HashIndex: index of table hashes, NumpyHashIndex for numpy engine
+        """
+        index = self.hash_indexes.get(table)
+        if index is None:
+            bits = HASH_ALGORITHMS[table_algorithm(table)][2]
+            if SIMILARITY_ENGINE == "numpy":
+                # snapshot of current generation has rows up to its newest message, only the rest
+                # is read from store; on other generation index is rebuilt from store
+                index = NumpyHashIndex(bits=bits, path=os.path.join(NUMPY_DIR, f"{table}.npy"),
+                                       generation=self.store.generation(table))
+                rows = self.store.load(table, after=index.last_id())
+            else:
+                index = HashIndex(bits=bits)
+                rows = self.store.load(table)
+            for message_id, value in rows:
+                index.add(message_id, value)
+            self.hash_indexes[table] = index
+        return index
+
+    def save_hash_indexes(self) -> None:
+        """Write snapshots of numpy indexes, so restart maps them instead of reading store."""
+        for table, index in list(self.hash_indexes.items()):
+            if isinstance(index, NumpyHashIndex):
+                with self.table_locks.setdefault(table, threading.Lock()):
+                    index.save()
+
+    def load_hash_indexes(self, owns=None) -> None:
+        """Load indexes of chat tables, so first photos don't pay for it.
 
-    def mysql_check_similarity(self, table:str, h:str, i:str=None, sc:int=SIMILARITY_COEF):
+        Args:
+            owns (callable, optional): table filter, shard worker loads only own chats.
+        """
+        for table in self.store.tables():
+            if table_algorithm(table) and (owns is None or owns(table)):
+                self.logger.info("loaded {} hashes for {}".format(len(self.get_hash_index(table)), table))
+
+    def check_file_id(self, table:str, file_unique_id:str, algorithm:str=DEFAULT_HASH_ALGORITHM) -> Optional[int]:
+        """Find message which already had exactly this telegram file,
+        forwards and reposts keep file_unique_id, so no download is needed.
+
+        Args:
+            table (str): chat id.
+            file_unique_id (str): telegram file_unique_id
+            algorithm (str, optional): hash algorithm of chat.
+
+        Returns:
+            int: message id or None
+        """
+        key = (self.tg_to_sql_chat_name(table, algorithm), file_unique_id)
+        message_id = self.file_ids.get(key)
+        if message_id is None:
+            row = self.store.get_file(*key)
+            if row:
+                message_id = row[0]
+                self.file_ids.put(key, message_id)
+        return message_id
+
+    def check_file_ids(self, table:str, file_unique_ids:list, algorithm:str=DEFAULT_HASH_ALGORITHM) -> dict:
+        """Batch check_file_id(), files missing in cache are fetched with one query.
+
+        Args:
+            table (str): chat id.
+            file_unique_ids (list): telegram file_unique_ids
+            algorithm (str, optional): hash algorithm of chat.
+
+        Returns:
+            dict: file_unique_id -> message id for known files
+        """
+        table = self.tg_to_sql_chat_name(table, algorithm)
+        known = {}
+        for file_unique_id in file_unique_ids:
+            message_id = self.file_ids.get((table, file_unique_id))
+            if message_id is not None:
+                known[file_unique_id] = message_id
+        missing = [f for f in file_unique_ids if f not in known]
+        for file_unique_id, (message_id, _) in self.store.get_files(table, missing).items():
+            self.file_ids.put((table, file_unique_id), message_id)
+            known[file_unique_id] = message_id
+        return known
+
+    def mysql_check_similarity(self, table:str, h:int, i:str=None, sc:int=SIMILARITY_COEF, algorithm:str=DEFAULT_HASH_ALGORITHM, file_unique_id:str=None):
         """This method will check if similar image is existing.
         Tune it with sc
 
         Args:
             table (str): mysql db table.
-            h (str): hash to check
+            h (int): hash to check
             i (str, optional): message id. Defaults to None.
             sc (int, optional): Similarity coefficent for image search.
+            algorithm (str, optional): hash algorithm of h.
+            file_unique_id (str, optional): telegram file id to remember for exact reposts.
 
         Returns:
             _type_: _description_
         """
-        table = self.tg_to_sql_chat_name(table)
-        res = self.mysql_pool.execute(f"SHOW TABLES LIKE '{table}';")
-        if not res:
+        table = self.tg_to_sql_chat_name(table, algorithm)
+        # check and insert must be atomic per chat, different chats run concurrently
+        with self.table_locks.setdefault(table, threading.Lock()):
+            if not self.store.has_table(table):
+                self.mysql_init_table(table_name = table)
+            # telegram file is written with the hash, exact repost of duplicate points to the same original
+            if SIMILARITY_ENGINE in ("index", "numpy"):
+                index = self.get_hash_index(table)
+                with metrics.timer("image_lookup"):
+                    res = index.query(h, sc)
+                if not res:
+                    with metrics.timer("image_insert"):
+                        self.store.insert(table, int(i), h, file_unique_id)
+                    index.add(int(i), h)
+                elif file_unique_id:
+                    with metrics.timer("image_insert"):
+                        self.store.put_file(table, file_unique_id, res[0], h)
+            else:
+                # lookup and insert are one transaction here, store records both stages
+                res = self.store.check_and_insert(table, int(i), h, sc, file_unique_id)
+            if file_unique_id:
+                self.file_ids.put((table, file_unique_id), res[0] if res else int(i))
+            if res:
+                return (r for r in res)
+            else:
+                return None
+
+    def mysql_check_similarity_many(self, table:str, hashes:list, sc:int=SIMILARITY_COEF, algorithm:str=DEFAULT_HASH_ALGORITHM) -> dict:
+        """Check several images of one chat at once, e.g. album.
+        Images are compared with stored ones in one lookup and with new
+        images before them in hashes, new ones and their telegram files
+        are inserted with one group commit.
+
+        Args:
+            table (str): chat id.
+            hashes (list): (message id, hash, file_unique_id) triples
+            sc (int, optional): Similarity coefficent for image search.
+            algorithm (str, optional): hash algorithm of hashes.
+
+        Returns:
+            dict: message id -> list of similar message ids, only for images with matches
+        """
+        table = self.tg_to_sql_chat_name(table, algorithm)
+        with self.table_locks.setdefault(table, threading.Lock()):
+            if not self.store.has_table(table):
+                self.mysql_init_table(table_name = table)
+            index = self.get_hash_index(table) if SIMILARITY_ENGINE in ("index", "numpy") else None
+            matches = {}
+            new = []
+            files = []
+            with metrics.timer("image_lookup"):
+                if index is not None:
+                    results = index.query_many([h for _, h, _ in hashes], sc)
+                else:
+                    results = self.store.scan_many(table, [h for _, h, _ in hashes], sc)
+                for (i, h, file_unique_id), res in zip(hashes, results):
+                    # earlier new images aren't stored yet, but are duplicates as well
+                    res = res + [m for m, v in new if (v ^ h).bit_count() <= sc]
+                    if res:
+                        matches[int(i)] = res
+                    else:
+                        new.append((int(i), h))
+                    if file_unique_id:
+                        files.append((file_unique_id, res[0] if res else int(i), h))
+            with metrics.timer("image_insert"):
+                self.store.insert_many(table, new, files)
+            if index is not None:
+                for i, h in new:
+                    index.add(i, h)
+            for file_unique_id, message_id, _ in files:
+                self.file_ids.put((table, file_unique_id), message_id)
+            return matches
+
+    def compact_table(self, table:str) -> Tuple[int, int]:
+        """Apply retention policy of chat to its table and merge
+        near-identical hashes into the oldest of them.
+        Near-identical groups are found without lock, photos of the chat
+        are blocked only while rows are deleted.
+
+        Args:
+            table (str): table name
+
+        Returns:
+            tuple: number of expired and merged rows
+        """
+        chat = table.partition('_')[0]
+        policies = {self.tg_to_sql_chat_name(chat_id): policy for chat_id, policy in CHAT_RETENTION.items()}
+        policy = {**DEFAULT_RETENTION, **policies.get(chat, {})}
+        expired = self.store.expired(table, policy["max_age_days"], policy["max_rows"])
+        expired_ids = set(expired)
+
+        groups = {}
+        if COMPACTION_DISTANCE is not None:
+            seen = HashIndex(bits=HASH_ALGORITHMS[table_algorithm(table)][2], max_distance=COMPACTION_DISTANCE)
+            for message_id, value in sorted(self.store.load(table)):
+                if message_id in expired_ids:
+                    continue
+                match = seen.query(value)
+                if match:
+                    groups.setdefault(match[0], []).append(message_id)
+                else:
+                    seen.add(message_id, value)
+
+        with self.table_locks.setdefault(table, threading.Lock()):
+            # exact reposts of dropped messages must not be answered from cache
+            for file_unique_id in self.store.delete(table, expired):
+                self.file_ids.pop((table, file_unique_id))
+            for message_id, merged_ids in groups.items():
+                self.store.merge(table, message_id, merged_ids)
+            index = self.hash_indexes.get(table)
+            if index is not None:
+                for message_id in expired:
+                    index.remove(message_id)
+                for merged_ids in groups.values():
+                    for message_id in merged_ids:
+                        index.remove(message_id)
+                if isinstance(index, NumpyHashIndex) and (expired or groups):
+                    # index follows store only if nobody else changed table meanwhile,
+                    # otherwise snapshot keeps old generation and is rebuilt on next start
+                    generation = self.store.generation(table)
+                    if index.generation + bool(expired) + len(groups) == generation:
+                        index.generation = generation
+                    index.save()
+        return len(expired), sum(len(merged_ids) for merged_ids in groups.values())
+
+    async def compaction_loop(self) -> None:
+        """Compact chat tables every COMPACTION_INTERVAL seconds, shard
+        worker compacts only its own chats."""
+        while True:
+            await asyncio.sleep(COMPACTION_INTERVAL)
+            for table in await self.store.run(self.store.tables):
+                if not table_algorithm(table) or (self.owns is not None and not self.owns(table)):
+                    continue
+                try:
+                    with metrics.timer("compaction"):
+                        expired, merged = await self.store.run(self.compact_table, table)
+                except Exception:
+                    self.logger.exception("compaction of {} failed".format(table))
+                    continue
+                if expired or merged:
+                    self.logger.info("compacted {}: {} expired, {} merged".format(table, expired, merged))
+
+    def backfill(self, export_dir:str, chat_id:str=None, workers:int=HASH_WORKERS) -> None:
+        """Index photos of telegram chat export (result.json and photos),
+        so reposts of old content are found too. Images are hashed in
+        process pool and inserted with multi-row INSERT per BACKFILL_BATCH.
+        Progress is saved to .backfill_<table> in export_dir, second run
+        continues after last saved message. Running bot loads new hashes
+        on restart.
+
+        Args:
+            export_dir (str): chat export directory
+            chat_id (str, optional): chat id as bot sees it. Defaults to id from export.
+            workers (int, optional): hashing processes.
+        """
+        with open(os.path.join(export_dir, "result.json"), encoding="utf-8") as f:
+            export = json.load(f)
+        if chat_id is None:
+            # supergroups and channels have -100 prefix in bot api, basic groups are negative
+            if export["type"] in ("private_supergroup", "public_supergroup", "private_channel", "public_channel"):
+                chat_id = f"-100{export['id']}"
+            elif export["type"] == "private_group":
+                chat_id = f"-{export['id']}"
+            else:
+                chat_id = str(export["id"])
+        algorithm = CHAT_HASH_ALGORITHMS.get(chat_id, DEFAULT_HASH_ALGORITHM)
+        table = self.tg_to_sql_chat_name(chat_id, algorithm)
+        if not self.store.has_table(table):
             self.mysql_init_table(table_name = table)
-        s_statement = f"SELECT `message_id` FROM `{table}` WHERE hamming_32(A0, A1, A2, A3,  CONV(SUBSTRING('{h}', 1,  8), 16, 10), CONV(SUBSTRING('{h}', 9,  8), 16, 10),  CONV(SUBSTRING('{h}', 17,  8), 16, 10), CONV(SUBSTRING('{h}', 25,  8), 16, 10)) <= {sc};"
-        res = self.mysql_pool.execute(s_statement)
-        if res:
-            return (r[0] for r in res)
-        else:
-            h_arr = [int(h[:8], 16), int(h[8:16], 16), int(h[16:24], 16), int(h[24:32], 16)]
-            ins = f'INSERT INTO `{table}` (message_id, A0, A1, A2, A3) VALUES (%s, %s, %s, %s, %s)' % (i, h_arr[0], h_arr[1], h_arr[2], h_arr[3])
-            self.mysql_pool.execute(ins, commit=True)
-            return None
+
+        checkpoint = os.path.join(export_dir, f".backfill_{table}")
+        last_id = 0
+        if os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                last_id = int(f.read() or 0)
+        existing = {message_id for message_id, _ in self.store.load(table)}
+        photos = [
+            (m["id"], os.path.join(export_dir, m.get("photo") or m["file"]))
+            for m in export.get("messages", ())
+            if m["id"] > last_id and m["id"] not in existing
+            and (m.get("photo") or str(m.get("mime_type", "")).startswith("image/") and m.get("file"))
+        ]
+        self.logger.info("backfill {}: {} photos to index, continuing after message {}".format(table, len(photos), last_id))
+
+        started = time.monotonic()
+        done = 0
+        batch = []
+        hash_file = functools.partial(hash_image_file, algorithm=algorithm)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            hashes = executor.map(hash_file, [path for _, path in photos], chunksize=64)
+            for (message_id, _), value in zip(photos, hashes):
+                if value is not None:
+                    batch.append((message_id, value))
+                done += 1
+                if len(batch) >= BACKFILL_BATCH or done == len(photos):
+                    self.store.insert_many(table, batch)
+                    batch = []
+                    with open(checkpoint, "w") as f:
+                        f.write(str(message_id))
+                    self.logger.info("backfill {}: {}/{} photos, {:.0f} photos/s".format(
+                        table, done, len(photos), done / max(time.monotonic() - started, 1e-9)))
+        # backfilled messages are older than those in numpy snapshots, they have to be rebuilt
+        if photos:
+            self.store.bump_generation(table)
+
+    async def show_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Shows latency percentiles and pool gauges, for admins only"""
+        if str(update.effective_chat.id) != DEVELOPER_CHAT_ID and update.effective_user.id not in ADMIN_USER_IDS:
+            return
+        self.reply(update.effective_message, metrics.summary())
 
     async def show_chats(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Shows which chats the bot is in"""
@@ -291,7 +2384,7 @@ class Imagebot():
             f" Moreover it is a member of the groups with IDs {group_ids} "
             f"and administrator in the channels with IDs {channel_ids}."
         )
-        await update.effective_message.reply_text(text)
+        self.reply(update.effective_message, text)
 
 
     async def error_handler(self, update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -382,35 +2475,104 @@ class Imagebot():
                 self.logger.info("%s removed the bot from the channel %s", cause_name, chat.title)
                 context.bot_data.setdefault("channel_ids", set()).discard(chat.id)
 
-    async def image_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        new_file = await context.bot.get_file(update.message.effective_attachment[0].file_id) if update.message else None
-        # will remove the error message on some images reaction 
-        if not new_file:
-            return
-
+    async def download_hash(self, context: ContextTypes.DEFAULT_TYPE, photo, algorithm:str=DEFAULT_HASH_ALGORITHM) -> int:
+        """Download photo and hash it in hash worker pool."""
+        with metrics.timer("image_get_file"):
+            new_file = await context.bot.get_file(photo.file_id)
         # File(file_id='AgACAgIAAx0Caq9aIwACAvlkz9Z85caAHYJGLXBrLZchuEXSOAACaNIxG7SweEpvM4Nl4ntQAAEBAAMCAANzAAMvBA', 
         # file_path='https://api.telegram.org/file/bot5483007201:AAG12Nj25PaWb1DVIhdw_2m64tDt2fowR0g/photos/file_9566.jpg', 
         # file_size=622, file_unique_id='AQADaNIxG7SweEp4')
-        new_file.file_unique_id
-        await new_file.download_to_drive(f"{TEMP_DIR_FULL_PATH}{new_file.file_unique_id}")
+        # decode and hash run together in hash worker, image_hash includes queue wait
+        if IMAGE_IN_MEMORY:
+            with metrics.timer("image_download"):
+                data = await new_file.download_as_bytearray()
+            with metrics.timer("image_hash"):
+                return await self.hash_pool.hash(data, algorithm)
+        img_file = f"{TEMP_DIR_FULL_PATH}{new_file.file_unique_id}"
+        with metrics.timer("image_download"):
+            await new_file.download_to_drive(img_file)
+        try:
+            with metrics.timer("image_hash"):
+                return await self.hash_pool.submit(hash_image, img_file, algorithm)
+        finally:
+            os.remove(img_file)
+
+    async def album_handler(self, media_group_id: str, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Check all photos of album collected during ALBUM_WINDOW at once
+        and send single reply."""
+        await asyncio.sleep(ALBUM_WINDOW)
+        messages = self.albums.pop(media_group_id)
+        chat_id = str(messages[0].chat.id)
+        algorithm = CHAT_HASH_ALGORITHMS.get(chat_id, DEFAULT_HASH_ALGORITHM)
+        photos = [m.effective_attachment[0] for m in messages]
+
+        known = await self.store.run(self.check_file_ids, chat_id, [p.file_unique_id for p in photos], algorithm)
+        todo = [(m, p) for m, p in zip(messages, photos) if p.file_unique_id not in known]
+        hashes = await asyncio.gather(*(self.download_hash(context, p, algorithm) for _, p in todo))
+        matches = await self.store.run(
+            self.mysql_check_similarity_many, chat_id,
+            [(m.message_id, h, p.file_unique_id) for (m, p), h in zip(todo, hashes)], algorithm=algorithm)
+
+        similar = set(known.values())
+        for message_ids in matches.values():
+            similar.update(message_ids)
+        if similar:
+            self.reply_similar(messages[0], sorted(similar))
 
-        img = Image.open(f"{TEMP_DIR_FULL_PATH}{new_file.file_unique_id}")
-        os.rename(f"{TEMP_DIR_FULL_PATH}{new_file.file_unique_id}", f"{TEMP_DIR_FULL_PATH}{new_file.file_unique_id}.{img.format}")
-        img_file = f"{TEMP_DIR_FULL_PATH}{new_file.file_unique_id}.{img.format}"
-        img.close()
+    async def image_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        # will remove the error message on some images reaction 
+        if not update.message:
+            return
+        if update.message.media_group_id:
+            album = self.albums.setdefault(update.message.media_group_id, [])
+            album.append(update.message)
+            if len(album) == 1:
+                context.application.create_task(self.album_handler(update.message.media_group_id, context), update=update)
+            return
+        photo = update.message.effective_attachment[0]
+        chat_id = str(update.message.chat.id)
+        algorithm = CHAT_HASH_ALGORITHMS.get(chat_id, DEFAULT_HASH_ALGORITHM)
+
+        # exact reposts are answered before download
+        message_id = self.file_ids.get((self.tg_to_sql_chat_name(chat_id, algorithm), photo.file_unique_id))
+        if message_id is None:
+            with metrics.timer("image_file_id_lookup"):
+                message_id = await self.store.run(self.check_file_id, chat_id, photo.file_unique_id, algorithm)
+        if message_id is not None:
+            self.reply_similar(update.message, [message_id])
+            return
 
-        # duplicates checking starts here
-        img_hash = imagehash.average_hash(Image.open(img_file), hash_size=11)
+        img_hash = await self.download_hash(context, photo, algorithm)
 
-        chat_id = str(update.message.chat.id)
-        s_hash = str(img_hash)
-        message_ids = self.mysql_check_similarity(chat_id, s_hash, update.message.message_id)
+        # duplicates checking starts here
+        # blocking db work goes to the store executor, event loop keeps handling other updates
+        message_ids = await self.store.run(
+            self.mysql_check_similarity, chat_id, img_hash, update.message.message_id, algorithm=algorithm,
+            file_unique_id=photo.file_unique_id)
 
         if message_ids:
-            for message_id in message_ids:
-                await update.message.reply_text(f"Similar to https://t.me/c/{chat_id[4:]}/{message_id}\n")
-                
-        os.remove(img_file)
+            self.reply_similar(update.message, list(message_ids))
+
+    def reply_similar(self, message, message_ids: list) -> None:
+        """Queue one reply with links to all similar messages.
+
+        Args:
+            message (Message): message with the photo
+            message_ids (list): ids of similar messages
+        """
+        chat_id = str(message.chat_id)
+        links = "\n".join(f"https://t.me/c/{chat_id[4:]}/{message_id}" for message_id in message_ids)
+        self.reply(message, f"Similar to {links}\n")
+
+    def reply(self, message, text: str, **kwargs) -> None:
+        """Queue reply to message in outbound queue.
+
+        Args:
+            message (Message): message to reply to
+            text (str): reply text
+        """
+        self.outbound.send(message.chat_id, text,
+                           reply_parameters=ReplyParameters(message.message_id, allow_sending_without_reply=True), **kwargs)
 
 
     async def greet_chat_members(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -424,18 +2586,21 @@ class Imagebot():
         member_name = update.chat_member.new_chat_member.user.mention_html()
 
 
+        # during raids greetings wait for chat rate limit and go out merged into one message
         if not was_member and is_member:
-            await update.effective_chat.send_message(
+            self.outbound.send(
+                update.effective_chat.id,
                 f"{member_name} was added by {cause_name}. Welcome!",
+                key="greeting",
                 parse_mode=ParseMode.HTML,
-
             )
 
         elif was_member and not is_member:
-            await update.effective_chat.send_message(
+            self.outbound.send(
+                update.effective_chat.id,
                 f"{member_name} is no longer with us. Thanks a lot, {cause_name} ...",
+                key="greeting",
                 parse_mode=ParseMode.HTML,
-
             )
 
     ### start weather parser
@@ -492,56 +2657,236 @@ class Imagebot():
         )
     ### end weather parser
 
+    async def fetch_weather(self, city: str) -> Weather:
+        """Request current weather for city from openweather."""
+        data = { 'appid':OPENWEATHER_APP_ID, 'q':city, 'units':'metric'}
+        with metrics.timer("weather"):
+            response = await self.http.get(OPENWEATHER_URL, params=data)
+        response.raise_for_status()
+        return self._parse_openweather_response(response.content)
+
     async def show_weather(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         message = update.message.text.replace('/weather ','')
-        
-        data = { 'appid':OPENWEATHER_APP_ID, 'q':message, 'units':'metric'}
-        query = f"https://api.openweathermap.org/data/2.5/weather?{urllib.parse.urlencode(data)}"
+        # "Moscow", " moscow " and "MOSCOW" share cache entry
+        city = " ".join(message.split()).casefold()
 
         try:
-            q = urllib.request.urlopen(query)
+            wthr = await self.weather_cache.get(city, functools.partial(self.fetch_weather, city))
         except Exception as e:
-            await update.effective_chat.send_message("😳")
+            self.outbound.send(update.effective_chat.id, "😳")
             return
 
-        response = q.read()
-        wthr = self._parse_openweather_response(response)
-
         ret =  f'{wthr.location}, {wthr.description}\n' \
             f'Temperature is {wthr.temperature}°C, feels like {wthr.temperature_feeling}°C\n' \
             f'Wind: {wthr.wind_direction}, {wthr.wind_speed} m/s\n' \
             f'Sunrise: {wthr.sunrise.strftime("%H:%M")}\n' \
             f'Sunset: {wthr.sunset.strftime("%H:%M")}\n'
 
-        await update.effective_chat.send_message(ret)
+        self.outbound.send(update.effective_chat.id, ret)
         
     async def chat_with_gpt(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         message = update.message.text.replace('/gpt ','')
-        
-        response = openai.ChatCompletion.create(
-              model="gpt-3.5-turbo",
-              messages=[{"role": "system", "content": 'You are a helpful assistant who understands a lot of topics and helping people to find answers. You can crack a joke or add misinformation to make reply more funny.'},
-                        {"role": "user", "content": f'{message}'}
-              ])
-        
-        bot_response = response["choices"][0]["message"]["content"]
-        
-        await update.effective_chat.send_message(bot_response)
 
-    def main(self) -> None:
-        """Run the bot."""
-        application = Application.builder().token(TOKEN).build()
+        chat_id = update.effective_chat.id
+        bot_response = self.gpt_cache.get(message) if self.gpt_cache is not None else None
+        if bot_response is not None:
+            self.outbound.send(chat_id, bot_response)
+            return
+
+        if self.gpt is None:
+            import openai
+
+            self.gpt = openai.AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
+        chat_semaphore = self.gpt_chat_semaphores.setdefault(chat_id, asyncio.Semaphore(GPT_CHAT_CONCURRENCY))
+        async with chat_semaphore, self.gpt_semaphore:
+            started = time.perf_counter()
+            stream = await self.gpt.chat.completions.create(
+                  model=GPT_MODEL,
+                  messages=[{"role": "system", "content": 'You are a helpful assistant who understands a lot of topics and helping people to find answers. You can crack a joke or add misinformation to make reply more funny.'},
+                            {"role": "user", "content": f'{message}'}
+                  ],
+                  stream=True)
+
+            # reply is sent with first tokens and edited at most every GPT_EDIT_INTERVAL seconds,
+            # both take tokens of chat and global outbound buckets
+            bot_response = ""
+            reply = None
+            sent = ""
+            last_edit = 0.0
+            async for chunk in stream:
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                bot_response += chunk.choices[0].delta.content
+                if time.monotonic() - last_edit < GPT_EDIT_INTERVAL:
+                    continue
+                if reply is None:
+                    reply = await self.outbound.call(chat_id, context.bot.send_message, chat_id, bot_response)
+                else:
+                    await self.outbound.call(chat_id, reply.edit_text, bot_response)
+                sent = bot_response
+                last_edit = time.monotonic()
+            metrics.observe("gpt", time.perf_counter() - started)
+
+        if not bot_response:
+            self.outbound.send(chat_id, "😳")
+            return
+        if reply is None:
+            self.outbound.send(chat_id, bot_response)
+        elif sent != bot_response:
+            await self.outbound.call(chat_id, reply.edit_text, bot_response)
+        if self.gpt_cache is not None:
+            self.gpt_cache.put(message, bot_response)
+
+    async def post_init(self, application: Application) -> None:
+        """Start background workers once event loop is running."""
+        await self.hash_pool.start()
+        self.outbound = OutboundQueue(application.bot)
+        self.http = httpx.AsyncClient(timeout=WEATHER_TIMEOUT)
+        self.gpt_semaphore = asyncio.Semaphore(GPT_MAX_CONCURRENCY)
+        if self.metrics_port:
+            self.metrics_server = await asyncio.start_server(metrics.serve_http, METRICS_HOST, self.metrics_port)
+        if COMPACTION_INTERVAL:
+            self.compaction_task = asyncio.create_task(self.compaction_loop())
+
+    async def post_shutdown(self, application: Application) -> None:
+        """Stop background workers."""
+        if SIMILARITY_ENGINE == "numpy":
+            await self.store.run(self.save_hash_indexes)
+        if self.outbound:
+            await self.outbound.stop()
+        if self.compaction_task:
+            self.compaction_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.compaction_task
+        await self.hash_pool.stop()
+        if self.http:
+            await self.http.aclose()
+        if self.gpt:
+            await self.gpt.close()
+        if self.metrics_server:
+            self.metrics_server.close()
+            await self.metrics_server.wait_closed()
+        # after compaction and index snapshots, which use store
+        self.store.close()
+
+    def build_application(self, bot_api_url:str=None) -> Application:
+        """Build application with all handlers.
+
+        Args:
+            bot_api_url (str, optional): Bot API server, e.g. local one or fake for benchmarks.
+
+        Returns:
+            Application: application
+        """
+        builder = Application.builder().token(TOKEN).post_init(self.post_init).post_shutdown(self.post_shutdown)
+        builder = builder.concurrent_updates(PerChatUpdateProcessor(CONCURRENT_UPDATES))
+        if bot_api_url:
+            builder = builder.base_url(f"{bot_api_url}/bot").base_file_url(f"{bot_api_url}/file/bot")
+        application = builder.build()
         application.add_handler(ChatMemberHandler(self.track_chats, ChatMemberHandler.MY_CHAT_MEMBER))
         application.add_handler(ChatMemberHandler(self.greet_chat_members, ChatMemberHandler.CHAT_MEMBER))
         application.add_handler(MessageHandler(filters.PHOTO, self.image_handler))
         application.add_handler(CommandHandler("show_chats", self.show_chats))
+        application.add_handler(CommandHandler("stats", self.show_stats))
         application.add_handler(CommandHandler("weather", self.show_weather))
         application.add_handler(CommandHandler("gpt", self.chat_with_gpt))
         application.add_error_handler(self.error_handler)
+        return application
 
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+    def main(self, webhook_url:str=None, listen:str="0.0.0.0", port:int=8443, secret_token:str=None, bot_api_url:str=None) -> None:
+        """Run the bot.
+
+        Args:
+            webhook_url (str, optional): public webhook url, long polling is used if not set.
+            listen (str, optional): webhook server address.
+            port (int, optional): webhook server port.
+            secret_token (str, optional): webhook secret token checked on every request.
+            bot_api_url (str, optional): Bot API server.
+        """
+        application = self.build_application(bot_api_url)
+
+        if SIMILARITY_ENGINE in ("index", "numpy"):
+            self.load_hash_indexes()
+
+        run_application(application, webhook_url=webhook_url, listen=listen, port=port, secret_token=secret_token)
+
+    async def _read_updates(self, application: Application, reader, writer) -> None:
+        try:
+            while True:
+                header = await reader.readexactly(4)
+                data = await reader.readexactly(int.from_bytes(header, "big"))
+                await application.update_queue.put(Update.de_json(json.loads(data), application.bot))
+        except asyncio.IncompleteReadError:
+            pass
+        finally:
+            writer.close()
+
+    async def run_shard_worker(self, address:str, bot_api_url:str=None) -> None:
+        """Process updates forwarded by ShardIngress, this worker owns
+        hash indexes and db connections of its chats.
+
+        Args:
+            address (str): unix:<path> or <host>:<port> to listen on
+            bot_api_url (str, optional): Bot API server.
+        """
+        if COMPACTION_INTERVAL and self.owns is None:
+            # without chat filter worker would compact tables indexed by other workers
+            raise ValueError("shard worker needs owns filter of its chats to run compaction")
+        application = self.build_application(bot_api_url)
+        async with application:
+            # post_init/post_shutdown are called by run_polling only
+            await self.post_init(application)
+            await application.start()
+            server = await start_shard_server(address, functools.partial(self._read_updates, application))
+            self.logger.info("shard worker listening on {}".format(address))
+            try:
+                async with server:
+                    await server.serve_forever()
+            finally:
+                await application.stop()
+                await self.post_shutdown(application)
 
 
 if __name__ == "__main__":
-    ib = Imagebot(MySQLPool(**DBCONFIG))
-    ib.main()
+    parser = argparse.ArgumentParser(description="Duplicate images, weather and gpt telegram bot")
+    parser.add_argument("--migrate", action="store_true", help="convert legacy A0..A3 hash tables to H0/H1, add retention columns and exit")
+    parser.add_argument("--backfill", metavar="EXPORT_DIR", help="index photos of telegram chat export (result.json) and exit")
+    parser.add_argument("--chat-id", help="chat id for --backfill, defaults to id from export")
+    parser.add_argument("--workers", type=int, default=HASH_WORKERS, help="hashing processes for --backfill")
+    parser.add_argument("--webhook", metavar="URL", help="receive updates on this public webhook url instead of polling")
+    parser.add_argument("--listen", default="0.0.0.0", help="webhook server address")
+    parser.add_argument("--port", type=int, default=8443, help="webhook server port")
+    parser.add_argument("--secret-token", help="webhook secret token")
+    parser.add_argument("--bot-api-url", help="Bot API server, e.g. https://api.telegram.org or local/fake one")
+    parser.add_argument("--shards", type=int, help="run ingress and this many local worker processes, chats are split between them")
+    parser.add_argument("--shard-addresses", help="comma separated host:port of all workers, run as ingress only or, "
+                                                  "with --shard-worker, tells worker which chats are its own")
+    parser.add_argument("--shard-worker", metavar="ADDRESS", help="run as worker listening on host:port (private network only) "
+                                                                  "or unix:<path>, needs --shard-addresses")
+    args = parser.parse_args()
+    run_kwargs = dict(webhook_url=args.webhook, listen=args.listen, port=args.port, secret_token=args.secret_token)
+
+    if (args.shards or args.shard_worker) and STORAGE_BACKEND == "rocksdb":
+        # rocksdb database is opened by a single process
+        parser.error("sharding works only with mysql storage backend")
+    if args.shard_worker and (not args.shard_addresses or args.shard_worker not in args.shard_addresses.split(",")):
+        parser.error("--shard-worker needs --shard-addresses of all workers including its own address")
+    if args.shards:
+        run_shards(args.shards, bot_api_url=args.bot_api_url, **run_kwargs)
+    elif args.shard_worker:
+        addresses = args.shard_addresses.split(",")
+        shard_worker_main(args.shard_worker, addresses, addresses.index(args.shard_worker), bot_api_url=args.bot_api_url)
+    elif args.shard_addresses:
+        ShardIngress(args.shard_addresses.split(",")).main(bot_api_url=args.bot_api_url, **run_kwargs)
+    else:
+        ib = Imagebot(create_store())
+        if args.migrate:
+            if not isinstance(ib.store, MySQLHashStore):
+                parser.error("--migrate works only with mysql storage backend")
+            ib.store.migrate_tables()
+            ib.store.close()
+        elif args.backfill:
+            ib.backfill(args.backfill, chat_id=args.chat_id, workers=args.workers)
+            ib.store.close()
+        else:
+            ib.main(bot_api_url=args.bot_api_url, **run_kwargs)
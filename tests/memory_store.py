@@ -0,0 +1,120 @@
+import threading
+import time
+
+import bot
+
+
+class MemoryHashStore(bot.HashStore):
+    """
+    HashStore kept in dicts, behaves like MySQLHashStore for tests and
+    benchmarks which shouldn't need a database. created maps table to
+    message id -> unix time the row was stored, set it to age rows.
+    """
+    def __init__(self):
+        self.rows = {}
+        self.created = {}
+        self.aliases = {}
+        self.files = {}
+        self.generations = {}
+        self.lock = threading.Lock()
+        # calls per method, e.g. round trips of a photo
+        self.calls = []
+
+    def tables(self) -> list:
+        return list(self.rows)
+
+    def has_table(self, table: str) -> bool:
+        return table in self.rows
+
+    def init_table(self, table: str) -> None:
+        with self.lock:
+            self.rows.setdefault(table, {})
+            self.created.setdefault(table, {})
+            self.aliases.setdefault(table, {})
+
+    def load(self, table: str, after=None):
+        self.calls.append("load")
+        return sorted((m, h) for m, h in self.rows[table].items() if after is None or m > after)
+
+    def scan(self, table: str, value: int, sc: int) -> list:
+        self.calls.append("scan")
+        return sorted(m for m, h in self.rows[table].items() if (h ^ value).bit_count() <= sc)
+
+    def scan_many(self, table: str, values: list, sc: int) -> list:
+        self.calls.append("scan_many")
+        rows = sorted(self.rows[table].items())
+        return [[m for m, h in rows if (h ^ value).bit_count() <= sc] for value in values]
+
+    def insert(self, table: str, message_id: int, value: int, file_unique_id=None) -> None:
+        self.calls.append("insert")
+        with self.lock:
+            self._insert(table, message_id, value)
+            if file_unique_id:
+                self.files.setdefault((table, file_unique_id), (message_id, value))
+
+    def insert_many(self, table: str, rows, files=()) -> None:
+        self.calls.append("insert_many")
+        with self.lock:
+            for message_id, value in rows:
+                self._insert(table, message_id, value)
+            for file_unique_id, message_id, value in files:
+                self.files.setdefault((table, file_unique_id), (message_id, value))
+
+    def _insert(self, table: str, message_id: int, value: int) -> None:
+        if message_id in self.rows[table]:
+            raise KeyError("duplicate message_id {}".format(message_id))
+        self.rows[table][message_id] = value
+        self.created[table][message_id] = time.time()
+
+    def get_file(self, table: str, file_unique_id: str):
+        self.calls.append("get_file")
+        return self.files.get((table, file_unique_id))
+
+    def put_file(self, table: str, file_unique_id: str, message_id: int, value: int) -> None:
+        self.calls.append("put_file")
+        with self.lock:
+            self.files.setdefault((table, file_unique_id), (message_id, value))
+
+    def expired(self, table: str, max_age_days=None, max_rows=None) -> list:
+        ids = set()
+        if max_age_days:
+            cutoff = time.time() - max_age_days * 86400
+            ids.update(m for m, created in self.created[table].items() if created < cutoff)
+        if max_rows:
+            ids.update(sorted(self.rows[table], reverse=True)[max_rows:])
+        return sorted(ids)
+
+    def delete(self, table: str, message_ids) -> list:
+        message_ids = set(message_ids)
+        if not message_ids:
+            return []
+        with self.lock:
+            for message_id in message_ids:
+                self.rows[table].pop(message_id, None)
+                self.created[table].pop(message_id, None)
+                self.aliases[table].pop(message_id, None)
+            files = [f for (t, f), (m, _) in self.files.items() if t == table and m in message_ids]
+            for file_unique_id in files:
+                del self.files[(table, file_unique_id)]
+            self.generations[table] = self.generations.get(table, 0) + 1
+        return files
+
+    def merge(self, table: str, message_id: int, merged_ids) -> None:
+        merged_ids = list(merged_ids)
+        if not merged_ids:
+            return
+        with self.lock:
+            aliases = self.aliases[table].setdefault(message_id, set())
+            for merged_id in merged_ids:
+                aliases.add(merged_id)
+                aliases.update(self.aliases[table].pop(merged_id, ()))
+                self.rows[table].pop(merged_id, None)
+                self.created[table].pop(merged_id, None)
+            self.generations[table] = self.generations.get(table, 0) + 1
+
+    def generation(self, table: str) -> int:
+        return self.generations.get(table, 0)
+
+    def bump_generation(self, table: str) -> None:
+        with self.lock:
+            self.generations[table] = self.generations.get(table, 0) + 1
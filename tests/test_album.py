@@ -0,0 +1,45 @@
+import pytest
+
+import bot
+from memory_store import MemoryHashStore
+
+CHAT = "-100123"
+H = 0xabc
+
+
+@pytest.fixture(params=["index", "numpy", "sql"])
+def ib(request, monkeypatch, tmp_path):
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+    monkeypatch.setattr(bot, "SIMILARITY_ENGINE", request.param)
+    monkeypatch.setattr(bot, "NUMPY_DIR", str(tmp_path))
+    ib = bot.Imagebot(MemoryHashStore(), metrics_port=None)
+    ib.table = ib.tg_to_sql_chat_name(CHAT)
+    return ib
+
+
+def test_duplicates_within_album(ib):
+    matches = ib.mysql_check_similarity_many(CHAT, [(1, H, None), (2, H, None), (3, H ^ 0xff00, None), (4, H ^ 1, None)])
+    assert matches == {2: [1], 4: [1]}
+    assert [m for m, _ in ib.store.load(ib.table)] == [1, 3]
+
+
+def test_album_against_stored_and_earlier_photos(ib):
+    assert ib.mysql_check_similarity(CHAT, H, "1") is None
+    ib.store.calls.clear()
+    matches = ib.mysql_check_similarity_many(CHAT, [(2, H ^ 1, "f2"), (3, H << 20, "f3"), (4, (H << 20) ^ 1, "f4")])
+    assert matches == {2: [1], 4: [3]}
+    # one lookup and one insert for whole album
+    lookups = [c for c in ib.store.calls if c in ("scan", "scan_many")]
+    assert lookups == (["scan_many"] if bot.SIMILARITY_ENGINE == "sql" else [])
+    assert ib.store.calls.count("insert_many") == 1
+    # exact reposts point to first message with similar image
+    assert ib.check_file_ids(CHAT, ["f2", "f3", "f4"]) == {"f2": 1, "f3": 3, "f4": 3}
+
+
+def test_scan_many_matches_scan():
+    store = MemoryHashStore()
+    store.init_table("t1")
+    store.insert_many("t1", [(m, H << 8 * m) for m in range(1, 14)])
+    values = [H << 24, (H << 40) ^ 3, 1 << 120]
+    assert bot.HashStore.scan_many(store, "t1", values, 4) == store.scan_many("t1", values, 4) == [[3], [5], []]
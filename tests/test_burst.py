@@ -0,0 +1,101 @@
+import asyncio
+import hashlib
+import time
+from datetime import datetime
+
+from telegram import Chat, Message, PhotoSize, Update
+
+import bot
+from memory_store import MemoryHashStore
+
+ROUND_TRIP = 0.02
+PHOTOS = 200
+CHATS = [-1001000000001 - k for k in range(4)]
+
+
+class SlowStore(MemoryHashStore):
+    """Round trips block calling thread like mysql.connector does."""
+    def get_file(self, *args):
+        time.sleep(ROUND_TRIP)
+        return super().get_file(*args)
+
+    def insert(self, *args):
+        time.sleep(ROUND_TRIP)
+        return super().insert(*args)
+
+    def put_file(self, *args):
+        time.sleep(ROUND_TRIP)
+        return super().put_file(*args)
+
+
+class HashPool(object):
+    async def hash(self, data, algorithm):
+        await asyncio.sleep(0.005)
+        return int.from_bytes(hashlib.md5(bytes(data)).digest(), "big") >> 7
+
+
+class File(object):
+    def __init__(self, file_id):
+        self.file_id = file_id
+
+    async def download_as_bytearray(self):
+        # file id up to '-' names image, so photos with same prefix are duplicates
+        return bytearray(self.file_id.split("-")[0].encode())
+
+
+class Bot(object):
+    async def get_file(self, file_id):
+        await asyncio.sleep(0.005)
+        return File(file_id)
+
+
+class Context(object):
+    bot = Bot()
+
+
+class Outbound(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+
+def message_update(update_id, chat_id, file_id=None):
+    chat = Chat(id=chat_id, type=Chat.SUPERGROUP)
+    photo = (PhotoSize(file_id, file_id, 256, 256),) if file_id else None
+    return Update(update_id, message=Message(update_id, datetime.now(), chat, photo=photo, text=None if file_id else "hi"))
+
+
+def test_photo_burst_doesnt_hold_other_chats(monkeypatch):
+    monkeypatch.setattr(bot, "SIMILARITY_ENGINE", "index")
+    ib = bot.Imagebot(SlowStore(), HashPool(), metrics_port=None)
+    ib.outbound = Outbound()
+    # every fifth photo after first 20 repeats one of them, in the same chat
+    photos = [message_update(k, CHATS[k % len(CHATS)], f"img{k % 20 if k % 5 == 4 and k >= 20 else k}-{k}")
+              for k in range(PHOTOS)]
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        processor = bot.PerChatUpdateProcessor(bot.CONCURRENT_UPDATES)
+        started = loop.time()
+        burst = [asyncio.create_task(processor.process_update(u, ib.image_handler(u, Context()))) for u in photos]
+        latencies = []
+        while not all(task.done() for task in burst):
+            # blocked loop shows as late wake up too
+            queued = loop.time() + 0.05
+            await asyncio.sleep(0.05)
+
+            async def other():
+                latencies.append(loop.time() - queued)
+
+            await processor.process_update(message_update(0, -1002, None), other())
+        await asyncio.gather(*burst)
+        return loop.time() - started, latencies
+
+    elapsed, latencies = asyncio.run(main())
+    # photos of one chat are handled one by one, each pays two round trips
+    assert elapsed > PHOTOS / len(CHATS) * ROUND_TRIP
+    assert len(latencies) >= 10
+    assert max(latencies) < 0.05
+    assert len(ib.outbound.sent) == (PHOTOS - 20) // 5
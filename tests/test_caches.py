@@ -0,0 +1,72 @@
+import asyncio
+
+import bot
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = bot.LRUCache(maxsize=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.pop("a") == 1
+    assert len(cache) == 1
+
+
+def test_ttl_cache_coalesces_concurrent_fetches():
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "value"
+
+    async def main():
+        cache = bot.TTLCache(ttl=60)
+        results = await asyncio.gather(*(cache.get("key", fetch) for _ in range(10)))
+        assert results == ["value"] * 10
+        assert await cache.get("key", fetch) == "value"
+
+    asyncio.run(main())
+    assert len(calls) == 1
+
+
+def test_ttl_cache_expires_and_skips_failures():
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError("upstream down")
+        return len(calls)
+
+    async def main():
+        cache = bot.TTLCache(ttl=0.05)
+        try:
+            await cache.get("key", fetch)
+        except RuntimeError:
+            pass
+        # failure isn't cached
+        assert await cache.get("key", fetch) == 2
+        assert await cache.get("key", fetch) == 2
+        await asyncio.sleep(0.1)
+        assert await cache.get("key", fetch) == 3
+
+    asyncio.run(main())
+
+
+def test_ttl_cache_waiter_cancel_doesnt_cancel_fetch():
+    async def fetch():
+        await asyncio.sleep(0.05)
+        return "value"
+
+    async def main():
+        cache = bot.TTLCache(ttl=60)
+        first = asyncio.ensure_future(cache.get("key", fetch))
+        second = asyncio.ensure_future(cache.get("key", fetch))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert await second == "value"
+
+    asyncio.run(main())
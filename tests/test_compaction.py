@@ -0,0 +1,156 @@
+import asyncio
+import hashlib
+import time
+
+import pytest
+
+import bot
+from memory_store import MemoryHashStore
+
+CHAT = "-1001"
+H = 0x1234567890abcdef1234567890abcd
+
+
+@pytest.fixture
+def ib(monkeypatch):
+    monkeypatch.setattr(bot, "DEFAULT_RETENTION", {"max_age_days": None, "max_rows": None})
+    monkeypatch.setattr(bot, "CHAT_RETENTION", {})
+    monkeypatch.setattr(bot, "COMPACTION_DISTANCE", 1)
+    monkeypatch.setattr(bot, "SIMILARITY_ENGINE", "index")
+    ib = bot.Imagebot(MemoryHashStore(), metrics_port=None)
+    ib.table = ib.tg_to_sql_chat_name(CHAT)
+    ib.store.init_table(ib.table)
+    return ib
+
+
+def far(k):
+    # hashes of different message ids are far apart
+    return int.from_bytes(hashlib.md5(str(k).encode()).digest(), "big") >> 7
+
+
+def fill(ib, ids):
+    ib.store.insert_many(ib.table, [(m, far(m)) for m in ids])
+
+
+def test_max_rows_keeps_newest(ib, monkeypatch):
+    monkeypatch.setitem(bot.CHAT_RETENTION, CHAT, {"max_rows": 3})
+    fill(ib, range(1, 11))
+    index = ib.get_hash_index(ib.table)
+    assert ib.compact_table(ib.table) == (7, 0)
+    assert [m for m, _ in ib.store.load(ib.table)] == [8, 9, 10]
+    assert index.query(far(1)) == []
+    assert index.query(far(9)) == [9]
+    # nothing is left out of retention
+    assert ib.store.expired(ib.table, max_rows=3) == []
+
+
+def test_max_age_drops_old_rows(ib, monkeypatch):
+    monkeypatch.setattr(bot, "DEFAULT_RETENTION", {"max_age_days": 30, "max_rows": None})
+    fill(ib, range(1, 6))
+    for m in (1, 2):
+        ib.store.created[ib.table][m] = time.time() - 31 * 86400
+    assert ib.compact_table(ib.table) == (2, 0)
+    assert [m for m, _ in ib.store.load(ib.table)] == [3, 4, 5]
+
+
+def test_near_identical_rows_merge_into_oldest(ib):
+    ib.store.insert_many(ib.table, [(1, H), (2, H ^ 1), (3, H ^ 2), (4, far(4)), (5, far(4) ^ 4)])
+    # 2 already kept id of message merged by earlier compaction
+    ib.store.aliases[ib.table][2] = {0}
+    index = ib.get_hash_index(ib.table)
+    assert ib.compact_table(ib.table) == (0, 3)
+    assert [m for m, _ in ib.store.load(ib.table)] == [1, 4]
+    assert ib.store.aliases[ib.table] == {1: {0, 2, 3}, 4: {5}}
+    assert index.query(H) == [1]
+    assert index.query(far(4)) == [4]
+    # second run has nothing to do and doesn't touch store
+    generation = ib.store.generation(ib.table)
+    assert ib.compact_table(ib.table) == (0, 0)
+    assert ib.store.generation(ib.table) == generation
+
+
+def test_expired_rows_are_not_merged(ib, monkeypatch):
+    monkeypatch.setitem(bot.CHAT_RETENTION, CHAT, {"max_rows": 2})
+    # 3 is near 2, both are near expired 1
+    ib.store.insert_many(ib.table, [(1, H), (2, H ^ 1), (3, H ^ 3)])
+    assert ib.compact_table(ib.table) == (1, 1)
+    assert [m for m, _ in ib.store.load(ib.table)] == [2]
+    assert ib.store.aliases[ib.table] == {2: {3}}
+
+
+def test_expired_files_leave_cache(ib, monkeypatch):
+    monkeypatch.setitem(bot.CHAT_RETENTION, CHAT, {"max_rows": 1})
+    ib.store.insert_many(ib.table, [(1, far(1)), (2, far(2))], [("old", 1, far(1)), ("new", 2, far(2))])
+    assert ib.check_file_id(CHAT, "old") == 1
+    assert ib.check_file_id(CHAT, "new") == 2
+    ib.compact_table(ib.table)
+    assert ib.file_ids.get((ib.table, "old")) is None
+    assert ib.check_file_id(CHAT, "old") is None
+    assert ib.check_file_id(CHAT, "new") == 2
+
+
+def test_compaction_loop_skips_foreign_tables(ib, monkeypatch):
+    monkeypatch.setattr(bot, "DEFAULT_RETENTION", {"max_age_days": None, "max_rows": 1})
+    monkeypatch.setattr(bot, "COMPACTION_INTERVAL", 0.01)
+    other = ib.tg_to_sql_chat_name("-1002")
+    ib.store.init_table(other)
+    fill(ib, [1, 2])
+    ib.store.insert_many(other, [(1, far(1)), (2, far(2))])
+    ib.owns = lambda table: table == ib.table
+
+    async def main():
+        task = asyncio.create_task(ib.compaction_loop())
+        await asyncio.sleep(0.2)
+        task.cancel()
+
+    asyncio.run(main())
+    assert [m for m, _ in ib.store.load(ib.table)] == [2]
+    assert [m for m, _ in ib.store.load(other)] == [1, 2]
+
+
+@pytest.fixture
+def numpy_ib(ib, monkeypatch, tmp_path):
+    pytest.importorskip("numpy")
+    monkeypatch.setattr(bot, "SIMILARITY_ENGINE", "numpy")
+    monkeypatch.setattr(bot, "NUMPY_DIR", str(tmp_path))
+    ib.store.insert_many(ib.table, [(10, H), (11, H ^ 1)] + [(m, far(m)) for m in range(12, 16)])
+    return ib
+
+
+def reopened(ib):
+    return bot.Imagebot(ib.store, metrics_port=None).get_hash_index(ib.table)
+
+
+def test_numpy_snapshot_follows_own_compaction(numpy_ib, monkeypatch):
+    index = numpy_ib.get_hash_index(numpy_ib.table)
+    assert index.generation == 0
+    monkeypatch.setitem(bot.CHAT_RETENTION, CHAT, {"max_rows": 4})
+    assert numpy_ib.compact_table(numpy_ib.table) == (2, 0)
+    assert index.generation == numpy_ib.store.generation(numpy_ib.table) == 1
+    monkeypatch.setitem(bot.CHAT_RETENTION, CHAT, {})
+    numpy_ib.store.insert(numpy_ib.table, 16, far(12) ^ 1)
+    index.add(16, far(12) ^ 1)
+    assert numpy_ib.compact_table(numpy_ib.table) == (0, 1)
+    assert index.generation == numpy_ib.store.generation(numpy_ib.table) == 2
+    assert index.query(far(12)) == [12]
+    # restart maps snapshot and reads only rows after it
+    assert len(bot.NumpyHashIndex(bits=121, path=index.path, generation=2)) == 4
+    numpy_ib.store.calls.clear()
+    assert len(reopened(numpy_ib)) == 4
+    assert numpy_ib.store.calls == ["load"]
+
+
+def test_numpy_snapshot_is_dropped_after_concurrent_change(numpy_ib):
+    index = numpy_ib.get_hash_index(numpy_ib.table)
+    # another process backfills older messages meanwhile
+    numpy_ib.store.insert_many(numpy_ib.table, [(1, far(1)), (2, far(2))])
+    numpy_ib.store.bump_generation(numpy_ib.table)
+    assert numpy_ib.compact_table(numpy_ib.table) == (0, 1)
+    assert numpy_ib.store.generation(numpy_ib.table) == 2
+    assert index.generation == 0
+    # snapshot of old generation is ignored, index is rebuilt with backfilled rows
+    assert len(bot.NumpyHashIndex(bits=121, path=index.path, generation=2)) == 0
+    rebuilt = reopened(numpy_ib)
+    assert rebuilt.generation == 2
+    assert len(rebuilt) == 7
+    assert rebuilt.query(far(1)) == [1]
@@ -0,0 +1,122 @@
+import asyncio
+import json
+import time
+from datetime import datetime
+
+import pytest
+from telegram import Chat, Message, Update
+
+import bot
+
+pytest.importorskip("openai")
+
+TOKENS = [f"word{k} " for k in range(10)]
+
+
+class OpenAIStub(object):
+    """Local http server streaming chat completion like openai, counts requests."""
+    def __init__(self, delay=0.03):
+        self.delay = delay
+        self.requests = []
+
+    async def handle(self, reader, writer):
+        head = await reader.readuntil(b"\r\n\r\n")
+        length = next(int(line.split(b":", 1)[1]) for line in head.split(b"\r\n")
+                      if line.lower().startswith(b"content-length:"))
+        body = json.loads(await reader.readexactly(length))
+        self.requests.append((head.split(b"\r\n", 1)[0].decode(), body))
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nConnection: close\r\n\r\n")
+        for token in TOKENS:
+            await asyncio.sleep(self.delay)
+            chunk = {"id": "chatcmpl-1", "object": "chat.completion.chunk", "created": 0, "model": body["model"],
+                     "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}
+            writer.write(b"data: %s\n\n" % json.dumps(chunk).encode())
+            await writer.drain()
+        writer.write(b"data: [DONE]\n\n")
+        await writer.drain()
+        writer.close()
+
+    async def __aenter__(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.url = "http://127.0.0.1:%d/v1" % self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *exc):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+class Reply(object):
+    def __init__(self, text):
+        self.text = text
+        self.edits = []
+
+    async def edit_text(self, text):
+        self.edits.append((time.monotonic(), text))
+        self.text = text
+
+
+class Outbound(object):
+    def __init__(self):
+        self.sent = []
+        self.replies = []
+
+    def send(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+    async def call(self, chat_id, func, *args, **kwargs):
+        return await func(*args, **kwargs)
+
+
+class Context(object):
+    def __init__(self, outbound):
+        self.bot = self
+        self.outbound = outbound
+
+    async def send_message(self, chat_id, text):
+        reply = Reply(text)
+        self.outbound.replies.append((chat_id, reply))
+        return reply
+
+
+def gpt_update(update_id, text):
+    chat = Chat(id=-1001, type=Chat.SUPERGROUP)
+    return Update(update_id, message=Message(update_id, datetime.now(), chat, text=f"/gpt {text}"))
+
+
+def test_streamed_reply_is_edited_and_cached(monkeypatch):
+    monkeypatch.setattr(bot, "OPENAI_API_KEY", "test")
+    monkeypatch.setattr(bot, "GPT_EDIT_INTERVAL", 0.1)
+
+    async def main():
+        async with OpenAIStub() as stub:
+            monkeypatch.setattr(bot, "OPENAI_BASE_URL", stub.url)
+            ib = bot.Imagebot(store=None, metrics_port=None)
+            ib.gpt_semaphore = asyncio.Semaphore(bot.GPT_MAX_CONCURRENCY)
+            ib.outbound = Outbound()
+            context = Context(ib.outbound)
+            try:
+                await ib.chat_with_gpt(gpt_update(1, "hello"), context)
+                await ib.chat_with_gpt(gpt_update(2, "hello"), context)
+            finally:
+                await ib.gpt.close()
+            return stub, ib.outbound
+
+    stub, outbound = asyncio.run(main())
+    assert len(stub.requests) == 1
+    request_line, body = stub.requests[0]
+    assert request_line.startswith("POST /v1/chat/completions")
+    assert body["stream"] and body["messages"][-1] == {"role": "user", "content": "hello"}
+
+    # one message sent with first tokens, then edited at most every GPT_EDIT_INTERVAL
+    text = "".join(TOKENS)
+    assert len(outbound.replies) == 1
+    chat_id, reply = outbound.replies[0]
+    assert chat_id == -1001 and reply.text == text
+    assert 1 <= len(reply.edits) < len(TOKENS) - 1
+    assert reply.edits[-1][1] == text
+    times = [t for t, _ in reply.edits[:-1]]
+    assert all(b - a >= 0.1 for a, b in zip(times, times[1:]))
+
+    # repeat is answered from cache without second request
+    assert outbound.sent == [(-1001, text)]
@@ -0,0 +1,69 @@
+import random
+
+import pytest
+
+import bot
+
+
+def near(value, bits, distance, rnd):
+    for k in rnd.sample(range(bits), distance):
+        value ^= 1 << k
+    return value
+
+
+@pytest.fixture
+def hashes():
+    rnd = random.Random(1)
+    base = [rnd.getrandbits(121) for _ in range(200)]
+    # clusters of near-duplicates around every base hash
+    return {m: near(base[m % len(base)], 121, rnd.randint(0, 6), rnd) for m in range(1000)}
+
+
+def brute_force(hashes, value, max_distance):
+    return sorted(m for m, h in hashes.items() if (h ^ value).bit_count() <= max_distance)
+
+
+@pytest.mark.parametrize("max_distance", [0, 2, 4])
+def test_query_matches_brute_force(hashes, max_distance):
+    index = bot.HashIndex(bits=121, max_distance=4)
+    for m, h in hashes.items():
+        index.add(m, h)
+    rnd = random.Random(2)
+    for value in list(hashes.values())[:100] + [rnd.getrandbits(121) for _ in range(20)]:
+        assert index.query(value, max_distance) == brute_force(hashes, value, max_distance)
+
+
+def test_query_beyond_index_radius(hashes):
+    index = bot.HashIndex(bits=121, max_distance=2)
+    for m, h in hashes.items():
+        index.add(m, h)
+    value = hashes[7]
+    assert index.query(value, 6) == brute_force(hashes, value, 6)
+
+
+def test_query_many(hashes):
+    index = bot.HashIndex(bits=121)
+    for m, h in hashes.items():
+        index.add(m, h)
+    values = [hashes[1], hashes[2], 0]
+    assert index.query_many(values) == [index.query(v) for v in values]
+
+
+def test_remove(hashes):
+    index = bot.HashIndex(bits=121)
+    for m, h in hashes.items():
+        index.add(m, h)
+    for m in range(0, 1000, 2):
+        index.remove(m)
+        del hashes[m]
+    index.remove(123456)
+    assert len(index) == len(hashes)
+    for value in list(hashes.values())[:50]:
+        assert index.query(value) == brute_force(hashes, value, bot.SIMILARITY_COEF)
+    # emptied buckets are dropped
+    assert all(ids for table in index._tables for ids in table.values())
+
+
+def test_split_join_hash():
+    value = (1 << 120) | 12345
+    assert bot.join_hash(*bot.split_hash(value)) == value
@@ -0,0 +1,137 @@
+"""
+Pool and MySQLHashStore against a real MySQL/MariaDB server, skipped
+unless MYSQL_TEST_DATABASE names a database the tests may write to:
+
+    MYSQL_TEST_DATABASE=test MYSQL_TEST_PASSWORD=... python -m pytest tests/test_mysql.py
+
+MYSQL_TEST_HOST, MYSQL_TEST_PORT and MYSQL_TEST_USER default to DBCONFIG
+of bot.py. Tables t990000001* are dropped after every test.
+"""
+import os
+import random
+import threading
+import time
+
+import pytest
+
+import bot
+
+pytest.importorskip("mysql.connector")
+if not os.environ.get("MYSQL_TEST_DATABASE"):
+    pytest.skip("MYSQL_TEST_DATABASE is not set", allow_module_level=True)
+
+TABLE = "t990000001"
+LEGACY = "t9900000012"
+
+
+def dbconfig():
+    config = {key: value for key, value in bot.DBCONFIG.items() if key != "pool_name"}
+    for key in ("host", "port", "user", "password", "database"):
+        config[key] = os.environ.get(f"MYSQL_TEST_{key.upper()}", config[key])
+    return config
+
+
+@pytest.fixture
+def pool():
+    pool = bot.MySQLPool(**dbconfig(), min_size=1, max_size=4, timeout=5)
+    yield pool
+    pool.executor.shutdown()
+
+
+@pytest.fixture
+def store(pool):
+    store = bot.MySQLHashStore(pool)
+
+    def drop():
+        for table in (TABLE, f"{TABLE}_phash", LEGACY, f"legacy_{LEGACY}", f"{LEGACY}_migrate"):
+            pool.execute(f"DROP TABLE IF EXISTS `{table}`", commit=True)
+        for table in (bot.file_ids_table, bot.generations_table):
+            pool.execute(f"DELETE FROM `{table}` WHERE chat_table LIKE %s", (f"{TABLE}%",), commit=True)
+
+    drop()
+    store.init_table(TABLE)
+    yield store
+    drop()
+
+
+def test_pool_queues_callers_over_max_size(pool):
+    errors = []
+
+    def query():
+        try:
+            pool.execute("SELECT SLEEP(0.05)")
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=query) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert pool.size <= pool.max_size and pool.in_use == 0
+    assert bot.metrics.histograms["mysql_pool_wait"].count >= 16
+
+
+def test_killed_connection_is_replaced(pool):
+    pool.health_check_interval = 0
+    conn = pool.get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT CONNECTION_ID()")
+    (connection_id,) = cursor.fetchone()
+    cursor.close()
+    pool.release(conn)
+    pool.execute(f"KILL {int(connection_id)}", commit=True)
+    time.sleep(0.01)
+    assert pool.execute("SELECT CONNECTION_ID()")[0][0] != connection_id
+    assert pool.in_use == 0
+
+
+def test_insert_scan_and_files(store):
+    h = random.Random(1).getrandbits(121)
+    store.insert(TABLE, 1, h, "f1")
+    store.insert_many(TABLE, [(2, h ^ 1), (3, h ^ (1 << 120))], [("f2", 2, h ^ 1)])
+    assert store.load(TABLE) == [(1, h), (2, h ^ 1), (3, h ^ (1 << 120))]
+    assert store.load(TABLE, after=1) == [(2, h ^ 1), (3, h ^ (1 << 120))]
+    assert sorted(store.scan(TABLE, h, 1)) == [1, 2]
+    assert store.scan_many(TABLE, [h, h ^ (1 << 120), 0], 1) == [[1, 2], [3], []]
+    assert store.get_file(TABLE, "f1") == (1, h)
+    assert store.get_files(TABLE, ["f1", "f2", "f3"]) == {"f1": (1, h), "f2": (2, h ^ 1)}
+    # lookup, insert and file go in one transaction
+    assert sorted(store.check_and_insert(TABLE, 4, h ^ 3, 2, "f4")) == [1, 2]
+    assert store.get_file(TABLE, "f4") == (1, h ^ 3)
+    assert store.check_and_insert(TABLE, 6, 0, 2, "f6") == []
+    assert store.load(TABLE, after=3) == [(6, 0)]
+    assert store.get_file(TABLE, "f6") == (6, 0)
+
+
+def test_expired_delete_and_merge(store):
+    store.insert_many(TABLE, [(m, m << 100) for m in range(1, 7)], [(f"f{m}", m, m << 100) for m in range(1, 7)])
+    store.mysql_pool.execute(f"UPDATE `{TABLE}` SET created_at = NOW() - INTERVAL 40 DAY WHERE message_id <= 2", commit=True)
+    assert store.expired(TABLE, max_age_days=30) == [1, 2]
+    assert store.expired(TABLE, max_rows=3) == [1, 2, 3]
+    assert sorted(store.delete(TABLE, [1, 2])) == ["f1", "f2"]
+    assert store.get_file(TABLE, "f1") is None
+    assert store.generation(TABLE) == 1
+    store.merge(TABLE, 4, [5])
+    store.merge(TABLE, 3, [4, 6])
+    assert [m for m, _ in store.load(TABLE)] == [3]
+    assert store.mysql_pool.execute(f"SELECT alias_ids FROM `{TABLE}`") == [("4,5,6",)]
+    assert store.generation(TABLE) == 3
+    store.bump_generation(TABLE)
+    assert store.generation(TABLE) == 4
+
+
+def test_migrate_legacy_table(store):
+    rnd = random.Random(2)
+    hashes = {m: rnd.getrandbits(121) for m in range(1, 50)}
+    store.mysql_pool.execute(
+        f"CREATE TABLE `{LEGACY}` (`message_id` int(11) NOT NULL, `A0` bigint(20) DEFAULT NULL, `A1` bigint(20) DEFAULT NULL, "
+        f"`A2` bigint(20) DEFAULT NULL, `A3` bigint(20) DEFAULT NULL, PRIMARY KEY (`message_id`))", commit=True)
+    rows = []
+    for m, value in hashes.items():
+        h = f"{value:0{bot.legacy_hex_len}x}"
+        rows.append((m, *(int(h[8 * k:8 * k + 8], 16) for k in range(4))))
+    store.mysql_pool.executemany(f"INSERT INTO `{LEGACY}` VALUES (%s, %s, %s, %s, %s)", rows, commit=True)
+    store.migrate_tables()
+    assert store.load(LEGACY) == sorted(hashes.items())
@@ -0,0 +1,179 @@
+import threading
+import time
+
+import pytest
+
+import bot
+
+errors = pytest.importorskip("mysql.connector.errors")
+
+
+class Cursor(object):
+    def __init__(self, conn, prepared=False):
+        self.conn = conn
+        self.prepared = prepared
+        self.closed = False
+
+    def execute(self, sql, args=None):
+        if self.conn.fail:
+            raise errors.OperationalError("lost connection")
+        self.conn.statements.append(sql)
+        self.conn.in_transaction = not sql.startswith("SELECT")
+
+    def executemany(self, sql, args):
+        self.execute(sql)
+
+    def fetchall(self):
+        return [(1,)]
+
+    def close(self):
+        self.closed = True
+
+
+class Connection(object):
+    """Stub of mysql.connector connection, counts what pool does with it."""
+    opened = 0
+
+    def __init__(self):
+        Connection.opened += 1
+        self.id = Connection.opened
+        self.statements = []
+        self.cursors = []
+        self.in_transaction = False
+        self.alive = True
+        self.fail = False
+        self.closed = False
+        self.pings = 0
+
+    def cursor(self, prepared=False):
+        cursor = Cursor(self, prepared)
+        self.cursors.append(cursor)
+        return cursor
+
+    def ping(self):
+        self.pings += 1
+        if not self.alive:
+            raise errors.InterfaceError("gone")
+
+    def commit(self):
+        self.in_transaction = False
+
+    def rollback(self):
+        if not self.alive:
+            raise errors.InterfaceError("gone")
+        self.in_transaction = False
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(bot.MySQLPool, "_connect", lambda self: Connection())
+
+    def pool(**kwargs):
+        kwargs = {"min_size": 1, "max_size": 3, "timeout": 0.2, "idle_timeout": 300, "health_check_interval": 30, **kwargs}
+        return bot.MySQLPool(**kwargs)
+
+    return pool
+
+
+def test_grows_to_max_size_then_times_out(pool):
+    p = pool()
+    assert p.size == 1
+    conns = [p.get_connection() for _ in range(3)]
+    assert len({c.id for c in conns}) == 3
+    assert (p.size, p.in_use) == (3, 3)
+    started = time.monotonic()
+    with pytest.raises(errors.PoolError):
+        p.get_connection()
+    assert time.monotonic() - started >= 0.2
+    assert p.waiting == 0
+    for c in conns:
+        p.release(c)
+    assert (p.size, p.in_use, len(p._idle)) == (3, 0, 3)
+    # newest idle connection is reused first
+    assert p.get_connection() is conns[-1]
+
+
+def test_release_hands_connection_to_waiter(pool):
+    p = pool(max_size=1, timeout=5)
+    conn = p.get_connection()
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(p.get_connection()))
+    waiter.start()
+    while not p.waiting:
+        time.sleep(0.001)
+    conn.in_transaction = True
+    p.release(conn)
+    waiter.join(1)
+    # open transaction is rolled back, session and connection are kept
+    assert got == [conn] and not conn.in_transaction
+    assert (p.size, p.in_use, p.waiting) == (1, 1, 0)
+
+
+def test_idle_connections_above_min_size_are_closed(pool):
+    p = pool(idle_timeout=0.05)
+    conns = [p.get_connection() for _ in range(3)]
+    for c in conns:
+        p.release(c)
+    time.sleep(0.1)
+    conn = p.get_connection()
+    # oldest two closed, newest is reused
+    assert conn is conns[-1]
+    assert [c.closed for c in conns] == [True, True, False]
+    assert (p.size, p.in_use) == (1, 1)
+
+
+def test_dead_idle_connection_is_replaced(pool):
+    p = pool(health_check_interval=0)
+    conn = p.get_connection()
+    p.release(conn)
+    pings = conn.pings
+    conn.alive = False
+    time.sleep(0.001)
+    fresh = p.get_connection()
+    assert conn.pings == pings + 1
+    # new connection isn't pinged
+    assert fresh is not conn and conn.closed and fresh.pings == 0
+    assert (p.size, p.in_use) == (1, 1)
+
+
+def test_execute_failure_keeps_pool_usable(pool):
+    p = pool(max_size=1)
+    conn = p.get_connection()
+    conn.fail = True
+    p.release(conn)
+    for _ in range(3):
+        with pytest.raises(errors.OperationalError):
+            p.execute("UPDATE t SET x = 1", commit=True)
+    assert (p.size, p.in_use) == (1, 0)
+    # connection which can't roll back is closed, next call opens a new one
+    conn.alive = False
+    with pytest.raises(errors.OperationalError):
+        p.execute("SELECT 1")
+    assert conn.closed and (p.size, p.in_use) == (0, 0)
+    assert p.execute("SELECT 1") == [(1,)]
+    assert (p.size, p.in_use) == (1, 0)
+
+
+def test_transaction_rolls_back_and_releases(pool):
+    p = pool(max_size=1)
+    with pytest.raises(ValueError):
+        with p.transaction() as conn:
+            p.prepared(conn, "INSERT INTO t VALUES (%s)").execute("INSERT INTO t VALUES (%s)", (1,))
+            raise ValueError
+    assert not conn.in_transaction and (p.size, p.in_use) == (1, 0)
+
+
+def test_prepared_statements_are_cached_per_connection(pool):
+    p = pool(prepared_cache_size=2)
+    with p.transaction() as conn:
+        first = p.prepared(conn, "SELECT 1")
+        assert p.prepared(conn, "SELECT 1") is first and first.prepared
+        p.prepared(conn, "SELECT 2")
+        p.prepared(conn, "SELECT 1")
+        # least recently used one is deallocated
+        p.prepared(conn, "SELECT 3")
+    assert [c.closed for c in conn.cursors] == [False, True, False]
+    assert list(p._statements[conn]) == ["SELECT 1", "SELECT 3"]
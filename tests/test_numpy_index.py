@@ -0,0 +1,68 @@
+import random
+
+import pytest
+
+import bot
+
+np = pytest.importorskip("numpy")
+
+
+def filled(index_class, hashes, **kwargs):
+    index = index_class(bits=121, **kwargs)
+    for m, h in hashes.items():
+        index.add(m, h)
+    return index
+
+
+@pytest.fixture
+def hashes():
+    rnd = random.Random(4)
+    base = [rnd.getrandbits(121) for _ in range(300)]
+    hashes = {}
+    for m in range(1, 1501):
+        value = base[m % len(base)]
+        for k in rnd.sample(range(121), rnd.randint(0, 6)):
+            value ^= 1 << k
+        hashes[m] = value
+    return hashes
+
+
+def test_parity_with_hash_index(hashes, monkeypatch):
+    # small chunks so several blocks are compared
+    monkeypatch.setattr(bot, "NUMPY_CHUNK", 256)
+    index, numpy_index = filled(bot.HashIndex, hashes), filled(bot.NumpyHashIndex, hashes)
+    queries = list(hashes.values())[:100] + [random.Random(5).getrandbits(121) for _ in range(20)]
+    for max_distance in (0, 2, 4):
+        assert numpy_index.query_many(queries, max_distance) == index.query_many(queries, max_distance)
+    assert numpy_index.query(queries[0]) == index.query(queries[0])
+    for m in range(1, 1501, 3):
+        index.remove(m)
+        numpy_index.remove(m)
+    assert len(numpy_index) == len(index)
+    assert numpy_index.query_many(queries) == index.query_many(queries)
+
+
+def test_snapshot_roundtrip(hashes, tmp_path):
+    path = str(tmp_path / "t1.npy")
+    index = filled(bot.NumpyHashIndex, hashes, path=path, generation=3)
+    index.remove(1)
+    index.save()
+    reopened = bot.NumpyHashIndex(bits=121, path=path, generation=3)
+    assert isinstance(reopened._base, np.memmap)
+    assert len(reopened) == len(hashes) - 1
+    assert reopened.last_id() == max(hashes)
+    assert reopened.query(hashes[2]) == index.query(hashes[2])
+    assert 1 not in reopened.query(hashes[1])
+
+
+def test_snapshot_of_other_generation_is_ignored(hashes, tmp_path):
+    path = str(tmp_path / "t1.npy")
+    filled(bot.NumpyHashIndex, hashes, path=path, generation=3).save()
+    stale = bot.NumpyHashIndex(bits=121, path=path, generation=4)
+    assert len(stale) == 0
+    assert stale.last_id() is None
+    # rebuilt index replaces snapshot with its generation
+    for m, h in hashes.items():
+        stale.add(m, h)
+    stale.save()
+    assert len(bot.NumpyHashIndex(bits=121, path=path, generation=4)) == len(hashes)
@@ -0,0 +1,142 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+from telegram.error import RetryAfter
+
+import bot
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(bot.time, "monotonic", clock)
+    return clock
+
+
+def test_token_bucket_burst_then_rate(clock):
+    bucket = bot.TokenBucket(rate=2.0, burst=3)
+    for _ in range(3):
+        assert bucket.delay() == 0
+        bucket.take()
+    assert bucket.delay() == pytest.approx(0.5)
+    clock.now += 0.5
+    assert bucket.delay() == 0
+    bucket.take()
+    # tokens don't pile up above burst
+    clock.now += 100
+    bucket.delay()
+    assert bucket.tokens == 3
+    assert bucket.full()
+
+
+def test_token_bucket_block(clock):
+    bucket = bot.TokenBucket(rate=1.0, burst=3)
+    bucket.block(5)
+    assert bucket.delay() == pytest.approx(5)
+    clock.now += 5
+    assert bucket.delay() == 0
+    bucket.take()
+    # no burst right after block
+    assert bucket.delay() == pytest.approx(1)
+    assert not bucket.full()
+
+
+class Bot(object):
+    def __init__(self, flood_chats=()):
+        self.sent = []
+        self.flood_chats = set(flood_chats)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if chat_id in self.flood_chats:
+            self.flood_chats.discard(chat_id)
+            raise RetryAfter(timedelta(seconds=1))
+        self.sent.append((chat_id, text, asyncio.get_running_loop().time()))
+        return text
+
+
+def run_queue(bot_, scenario, **kwargs):
+    async def main():
+        queue = bot.OutboundQueue(bot_, **kwargs)
+        try:
+            await scenario(queue)
+        finally:
+            await queue.stop()
+        return queue
+
+    return asyncio.run(main())
+
+
+def test_waiting_messages_with_same_key_are_merged():
+    sender = Bot()
+
+    async def scenario(queue):
+        for k in range(5):
+            queue.send(1, f"greeting {k}", key="greeting")
+        queue.send(1, "other")
+        await asyncio.sleep(0.1)
+
+    queue = run_queue(sender, scenario)
+    assert [text for _, text, _ in sender.sent] == ["\n".join(f"greeting {k}" for k in range(5)), "other"]
+    assert not queue.pending and not queue.senders
+
+
+def test_merged_message_respects_telegram_limit():
+    sender = Bot()
+    part = "x" * 3000
+
+    async def scenario(queue):
+        queue.send(1, part, key="k")
+        queue.send(1, part, key="k")
+        await asyncio.sleep(0.1)
+
+    run_queue(sender, scenario)
+    assert [text for _, text, _ in sender.sent] == [part, part]
+
+
+def test_chat_rate_limit():
+    sender = Bot()
+
+    async def scenario(queue):
+        for k in range(4):
+            queue.send(1, str(k))
+        await asyncio.sleep(0.5)
+
+    run_queue(sender, scenario, chat_rate=10.0, chat_burst=2)
+    times = [t for _, _, t in sender.sent]
+    assert len(times) == 4
+    # burst of 2 at once, then 10 per second
+    assert times[1] - times[0] < 0.05
+    assert times[3] - times[1] >= 0.15
+
+
+def test_retry_after_pauses_only_its_chat():
+    sender = Bot(flood_chats={1})
+
+    async def scenario(queue):
+        queue.send(1, "flooded")
+        queue.send(2, "free")
+        await asyncio.sleep(0.1)
+        assert [chat for chat, _, _ in sender.sent] == [2]
+        await asyncio.sleep(1.1)
+
+    run_queue(sender, scenario)
+    assert [chat for chat, _, _ in sender.sent] == [2, 1]
+
+
+def test_call_returns_result_and_retries():
+    sender = Bot(flood_chats={1})
+
+    async def scenario(queue):
+        assert await queue.call(1, sender.send_message, 1, "edit me") == "edit me"
+
+    run_queue(sender, scenario)
+    assert [text for _, text, _ in sender.sent] == ["edit me"]
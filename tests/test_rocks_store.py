@@ -0,0 +1,107 @@
+import time
+
+import pytest
+
+import bot
+
+pytest.importorskip("rocksdict")
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = bot.RocksHashStore(str(tmp_path / "db"))
+    store.init_table("t1")
+    store.init_table("t1_phash")
+    yield store
+    store.close()
+
+
+def key(table, message_id):
+    return f"{table}:".encode() + message_id.to_bytes(8, "big")
+
+
+def test_key_layout(store):
+    store.insert("t1", 5, 1 << 120, "f5")
+    store.insert("t1_phash", 6, 7)
+    store.bump_generation("t1")
+    assert [k for k, _ in store.db.items()] == [b"!t1", b"!t1_phash", b"#t1:f5", b"%t1", key("t1", 5), key("t1_phash", 6)]
+    value = store.db[key("t1", 5)]
+    assert value[:16] == (1 << 120).to_bytes(16, "big")
+    assert abs(int.from_bytes(value[16:24], "big") - time.time()) < 5
+    assert store.db[b"#t1:f5"] == (5).to_bytes(8, "big") + (1 << 120).to_bytes(16, "big")
+    assert sorted(store.tables()) == ["t1", "t1_phash"]
+    assert store.has_table("t1") and not store.has_table("t2")
+
+
+def test_load_is_ordered_and_per_table(store):
+    # big-endian ids sort numerically, 256 would sort before 2 as text
+    store.insert_many("t1", [(256, 1), (2, 2), (70000, 3)])
+    store.insert_many("t1_phash", [(1, 4)])
+    assert list(store.load("t1")) == [(2, 2), (256, 1), (70000, 3)]
+    assert list(store.load("t1", after=2)) == [(256, 1), (70000, 3)]
+    assert list(store.load("t1", after=70000)) == []
+    assert list(store.load("t1_phash")) == [(1, 4)]
+
+
+def test_scan(store):
+    store.insert_many("t1", [(1, 0b1111), (2, 0b0111), (3, 0b0001)])
+    assert store.scan("t1", 0b1111, 1) == [1, 2]
+    assert store.scan_many("t1", [0b1111, 0b0011, 1 << 100], 1) == [[1, 2], [2, 3], []]
+
+
+def test_files_keep_first_message(store):
+    store.insert("t1", 1, 10, "f")
+    store.put_file("t1", "f", 2, 11)
+    store.insert_many("t1", [(3, 12)], [("f", 3, 12), ("g", 3, 12)])
+    assert store.get_file("t1", "f") == (1, 10)
+    assert store.get_files("t1", ["f", "g", "h"]) == {"f": (1, 10), "g": (3, 12)}
+    assert store.get_file("t1_phash", "f") is None
+
+
+def test_expired(store):
+    now = int(time.time())
+    for message_id, age_days in ((1, 40), (2, 31), (3, 1), (4, 0)):
+        store.db[key("t1", message_id)] = store._pack(message_id, now - age_days * 86400)
+    # rows without time are never too old
+    store.db[key("t1", 5)] = store._pack(5, 0)
+    assert store.expired("t1") == []
+    assert store.expired("t1", max_age_days=30) == [1, 2]
+    assert store.expired("t1", max_rows=2) == [1, 2, 3]
+    assert store.expired("t1", max_age_days=2, max_rows=4) == [1, 2]
+
+
+def test_delete_returns_files_and_bumps_generation(store):
+    store.insert_many("t1", [(1, 10), (2, 11), (3, 12)], [("a", 1, 10), ("b", 2, 11), ("c", 3, 12)])
+    assert store.delete("t1", []) == []
+    assert store.generation("t1") == 0
+    assert sorted(store.delete("t1", [1, 2])) == ["a", "b"]
+    assert list(store.load("t1")) == [(3, 12)]
+    assert store.get_file("t1", "a") is None
+    assert store.generation("t1") == 1
+    assert store.generation("t1_phash") == 0
+
+
+def test_merge_keeps_aliases(store):
+    store.insert_many("t1", [(1, 10), (2, 11), (3, 12), (4, 13)])
+    store.merge("t1", 2, [3])
+    store.merge("t1", 1, [2, 4, 99])
+    assert list(store.load("t1")) == [(1, 10)]
+    assert store._aliases(store.db[key("t1", 1)]) == [2, 3, 4]
+    assert store.generation("t1") == 2
+    # kept row keeps its time, so retention still sees its age
+    created = int.from_bytes(store.db[key("t1", 1)][16:24], "big")
+    assert abs(created - time.time()) < 5
+
+
+def test_reopen(tmp_path):
+    path = str(tmp_path / "db")
+    store = bot.RocksHashStore(path)
+    store.init_table("t1")
+    store.insert("t1", 1, 10, "f")
+    store.bump_generation("t1")
+    store.close()
+    store = bot.RocksHashStore(path)
+    assert list(store.load("t1")) == [(1, 10)]
+    assert store.get_file("t1", "f") == (1, 10)
+    assert store.generation("t1") == 1
+    store.close()
@@ -0,0 +1,96 @@
+import asyncio
+import os
+import tempfile
+from collections import Counter
+
+import pytest
+
+import bot
+
+NODES = [f"unix:/tmp/shard{i}.sock" for i in range(3)]
+CHATS = [-1001000000000 - k * 7919 for k in range(10000)]
+
+
+def test_ring_is_deterministic_and_ignores_sign():
+    ring, other = bot.HashRing(NODES), bot.HashRing(list(reversed(NODES)))
+    for chat_id in CHATS[:100]:
+        assert ring.node(chat_id) == other.node(chat_id) == ring.node(-chat_id) == ring.node(str(chat_id))
+
+
+def test_ring_spreads_chats():
+    counts = Counter(bot.HashRing(NODES).node(chat_id) for chat_id in CHATS)
+    assert set(counts) == set(NODES)
+    assert max(counts.values()) < 1.5 * len(CHATS) / len(NODES)
+
+
+def test_adding_node_moves_only_its_share():
+    before, after = bot.HashRing(NODES), bot.HashRing(NODES + ["unix:/tmp/shard3.sock"])
+    moved = [chat_id for chat_id in CHATS if before.node(chat_id) != after.node(chat_id)]
+    assert all(after.node(chat_id) == "unix:/tmp/shard3.sock" for chat_id in moved)
+    assert 0.1 < len(moved) / len(CHATS) < 0.4
+
+
+def test_table_name_maps_to_chat_owner():
+    # shard worker preloads indexes by table name, abs(chat id) is its suffix
+    ring = bot.HashRing(NODES)
+    ib = bot.Imagebot(store=None, metrics_port=None)
+    for chat_id in CHATS[:100]:
+        table = ib.tg_to_sql_chat_name(str(chat_id), "phash")
+        assert ring.node(table.partition('_')[0][len(bot.table_prefix):]) == ring.node(chat_id)
+
+
+def test_shard_connection_over_unix_socket():
+    async def main():
+        received = []
+
+        async def echo(reader, writer):
+            received.append(await reader.readexactly(5))
+            writer.close()
+
+        path = os.path.join(tempfile.mkdtemp(), "shard.sock")
+        server = await bot.start_shard_server(f"unix:{path}", echo)
+        async with server:
+            reader, writer = await bot.open_shard_connection(f"unix:{path}")
+            writer.write(b"hello")
+            await writer.drain()
+            await reader.read()
+            writer.close()
+        return received
+
+    assert asyncio.run(main()) == [b"hello"]
+
+
+def test_shard_worker_owns_only_its_chats(monkeypatch):
+    from memory_store import MemoryHashStore
+
+    store = MemoryHashStore()
+    ib = bot.Imagebot(store=None, metrics_port=None)
+    tables = [ib.tg_to_sql_chat_name(str(chat_id)) for chat_id in CHATS[:30]]
+    for table in tables:
+        store.init_table(table)
+    started = {}
+
+    async def run_shard_worker(self, address, bot_api_url=None):
+        started["owns"] = self.owns
+        started["indexes"] = set(self.hash_indexes)
+
+    monkeypatch.setattr(bot, "create_store", lambda: store)
+    monkeypatch.setattr(bot.Imagebot, "run_shard_worker", run_shard_worker)
+    bot.shard_worker_main(NODES[1], NODES, 1)
+    ring = bot.HashRing(NODES)
+    own = {table for table, chat_id in zip(tables, CHATS) if ring.node(chat_id) == NODES[1]}
+    assert own and own != set(tables)
+    assert {table for table in tables if started["owns"](table)} == own
+    assert started["indexes"] == own
+
+
+def test_shard_worker_address_must_be_in_ring():
+    with pytest.raises(ValueError):
+        bot.shard_worker_main("unix:/tmp/other.sock", NODES)
+
+
+def test_shard_worker_without_owns_refuses_compaction(monkeypatch):
+    monkeypatch.setattr(bot, "COMPACTION_INTERVAL", 3600)
+    ib = bot.Imagebot(store=None, metrics_port=None)
+    with pytest.raises(ValueError):
+        asyncio.run(ib.run_shard_worker(NODES[0]))
@@ -0,0 +1,46 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+# modules of photo, gpt and storage features, bot.py imports them where they are first needed
+HEAVY_MODULES = ["PIL", "imagehash", "numpy", "scipy", "pandas", "pywt", "openai", "mysql", "rocksdict"]
+# peak RSS of interpreter with bot imported, it is ~40MB with telegram and httpx
+RSS_LIMIT_MB = 80
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# VmHWM is peak of this process image, ru_maxrss would keep peak of forking test runner
+PROBE = """
+import os
+import bot
+if os.path.exists("/proc/self/status"):
+    with open("/proc/self/status") as f:
+        print(next(int(line.split()[1]) for line in f if line.startswith("VmHWM:")) // 1024)
+"""
+
+
+def import_bot():
+    return subprocess.run([sys.executable, "-X", "importtime", "-c", PROBE], cwd=ROOT,
+                          capture_output=True, text=True, check=True)
+
+
+def test_import_doesnt_load_heavy_modules():
+    result = import_bot()
+    # "import time: self [us] | cumulative | imported package"
+    imported = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, name = line[len("import time:"):].split("|")
+            if cumulative.strip().isdigit():
+                imported[name.strip()] = int(cumulative)
+    loaded = [name for name in imported if name.split(".")[0] in HEAVY_MODULES]
+    slowest = sorted(imported.items(), key=lambda item: -item[1])[:10]
+    assert not loaded, f"heavy modules imported at startup: {loaded}, slowest imports: {slowest}"
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/status"), reason="needs linux /proc")
+def test_import_rss():
+    rss = int(import_bot().stdout.split()[-1])
+    assert rss < RSS_LIMIT_MB, f"peak RSS after import is {rss}MB"
@@ -0,0 +1,57 @@
+import asyncio
+from datetime import datetime
+
+from telegram import Chat, Message, Update
+
+import bot
+
+
+def update(update_id, chat_id):
+    chat = Chat(id=chat_id, type=Chat.SUPERGROUP)
+    return Update(update_id, message=Message(update_id, datetime.now(), chat, text="hi"))
+
+
+def test_busy_chat_keeps_order_and_doesnt_hold_others():
+    async def main():
+        processor = bot.PerChatUpdateProcessor(max_concurrent_updates=4)
+        done = []
+        gate = asyncio.Event()
+
+        async def handle(update_id, chat_id):
+            if chat_id == 1:
+                await gate.wait()
+            done.append((update_id, chat_id))
+
+        busy = [asyncio.create_task(processor.process_update(update(k, 1), handle(k, 1))) for k in range(100)]
+        await asyncio.sleep(0.01)
+        # 100 updates of chat 1 are admitted, one of them runs
+        assert processor.current_concurrent_updates == 100
+        await asyncio.wait_for(processor.process_update(update(100, 2), handle(100, 2)), 1)
+        assert done == [(100, 2)]
+        gate.set()
+        await asyncio.gather(*busy)
+        assert done[1:] == [(k, 1) for k in range(100)]
+        assert processor.current_concurrent_updates == 0
+        assert not processor._locks
+
+    asyncio.run(main())
+
+
+def test_slots_bound_running_updates():
+    async def main():
+        processor = bot.PerChatUpdateProcessor(max_concurrent_updates=3)
+        running = []
+        peak = 0
+
+        async def handle():
+            nonlocal peak
+            running.append(1)
+            peak = max(peak, len(running))
+            await asyncio.sleep(0.01)
+            running.pop()
+
+        await asyncio.gather(*(processor.process_update(update(k, k), handle()) for k in range(20)),
+                             *(processor.process_update(object(), handle()) for k in range(5)))
+        return peak
+
+    assert asyncio.run(main()) == 3
@@ -0,0 +1,107 @@
+import asyncio
+import json
+from datetime import datetime
+
+import httpx
+from telegram import Chat, Message, Update
+
+import bot
+
+OPENWEATHER_RESPONSE = {
+    "name": "Moscow",
+    "main": {"temp": 12.5, "feels_like": 11.0},
+    "weather": [{"description": "light rain"}],
+    "sys": {"sunrise": 1700000000, "sunset": 1700030000},
+    "wind": {"speed": 3.0, "deg": 90},
+}
+
+
+class OpenWeatherStub(object):
+    """Local http server answering like openweather, counts requests."""
+    def __init__(self, delay=0.1):
+        self.delay = delay
+        self.requests = []
+
+    async def handle(self, reader, writer):
+        request = await reader.readuntil(b"\r\n\r\n")
+        self.requests.append(request.split(b"\r\n", 1)[0].decode())
+        await asyncio.sleep(self.delay)
+        body = json.dumps(OPENWEATHER_RESPONSE).encode()
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                     b"Content-Length: %d\r\nConnection: close\r\n\r\n%s" % (len(body), body))
+        await writer.drain()
+        writer.close()
+
+    async def __aenter__(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.url = "http://127.0.0.1:%d/data/2.5/weather" % self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *exc):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+class Outbound(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+
+def weather_update(update_id, city):
+    chat = Chat(id=-1001, type=Chat.SUPERGROUP)
+    return Update(update_id, message=Message(update_id, datetime.now(), chat, text=f"/weather {city}"))
+
+
+def run_bot(monkeypatch, ttl, scenario):
+    async def main():
+        async with OpenWeatherStub() as stub:
+            monkeypatch.setattr(bot, "OPENWEATHER_URL", stub.url)
+            ib = bot.Imagebot(store=None, metrics_port=None)
+            ib.http = httpx.AsyncClient(timeout=5)
+            ib.weather_cache = bot.TTLCache(ttl=ttl)
+            ib.outbound = Outbound()
+            try:
+                await scenario(ib)
+            finally:
+                await ib.http.aclose()
+            return stub, ib.outbound
+
+    return asyncio.run(main())
+
+
+def test_concurrent_weather_requests_hit_upstream_once(monkeypatch):
+    async def scenario(ib):
+        # differently written city shares cache entry
+        await asyncio.gather(*(ib.show_weather(weather_update(k, city), None)
+                               for k, city in enumerate(["Moscow", " moscow ", "MOSCOW", "Moscow"])))
+
+    stub, outbound = run_bot(monkeypatch, 60, scenario)
+    assert len(stub.requests) == 1
+    assert "q=moscow" in stub.requests[0]
+    assert len(outbound.sent) == 4
+    assert all(text.startswith("Moscow, Light rain") for _, text in outbound.sent)
+
+
+def test_fetch_weather_parses_response(monkeypatch):
+    async def scenario(ib):
+        weather = await ib.fetch_weather("moscow")
+        assert weather.temperature == 12.5
+        assert weather.wind_direction == "East"
+
+    stub, _ = run_bot(monkeypatch, 60, scenario)
+    assert len(stub.requests) == 1
+
+
+def test_weather_cache_expires(monkeypatch):
+    async def scenario(ib):
+        await ib.show_weather(weather_update(1, "Moscow"), None)
+        await ib.show_weather(weather_update(2, "Moscow"), None)
+        await asyncio.sleep(0.3)
+        await ib.show_weather(weather_update(3, "Moscow"), None)
+
+    stub, outbound = run_bot(monkeypatch, 0.2, scenario)
+    assert len(stub.requests) == 2
+    assert len(outbound.sent) == 3